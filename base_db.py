@@ -6,16 +6,25 @@ Local database base class for behavioral, ephys and fiber photometry data so the
 """
 
 from abc import ABC, abstractmethod
+import os
 import os.path as path
 import glob
 import pandas as pd
+from pandas.api.types import union_categoricals
 import numpy as np
 import pickle
 import db_access
 import pyutils.utils as utils
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from importlib.util import find_spec
 import time
 
+# compress local session files with zstd when it is installed
+# compressed files are recognized by their header when read so older uncompressed files can still be read
+_local_compression = {'method': 'zstd', 'level': 3} if find_spec('zstandard') is not None else None
+_zstd_header = b'\x28\xb5\x2f\xfd'
+
 
 # make this class abstract so other local database classed can inherit and implement their unique
 # handling of behaviorally relevant method variables
@@ -39,6 +48,10 @@ class LocalDB_Base(ABC):
             data_dir = path.join(utils.get_user_home(), 'db_data', self.protocol_name)
 
         self.__data_dir = data_dir
+        # build the local data directories once since file paths are generated for every session
+        self.__unit_dir = path.join(data_dir, 'units')
+        self.__fp_dir = path.join(data_dir, 'fp')
+        self.__beh_dir = path.join(data_dir, 'beh')
         self.__load_local_data()
 
     #%% Properties
@@ -50,21 +63,25 @@ class LocalDB_Base(ABC):
     @property
     def local_sessions(self):
         ''' Get all local session ids, with associated subject ids and dates '''
+        self.__flush_local_data()
         return self.__local_data['sessions']
 
     @property
     def local_units(self):
         ''' Get all local unit ids, with associated subject and session ids '''
+        self.__flush_local_data()
         return self.__local_data['units']
 
     @property
     def local_fp_data(self):
         ''' Get all local fiber photometry ids, with associated subject and session ids '''
+        self.__flush_local_data()
         return self.__local_data['fp_data']
 
     @property
     def local_subjects(self):
         ''' Get all local subject ids and their respective local unit, session, and fp ids '''
+        self.__flush_local_data()
         sess_ids = self.__local_data['sessions'].groupby('subjid').agg(list)['sessid'].apply(lambda x: sorted(x))
         unit_ids = self.__local_data['units'].groupby('subjid').agg(list)['unitid'].apply(lambda x: sorted(x))
         fp_ids = self.__local_data['fp_data'].groupby('subjid').agg(list)['fpid'].apply(lambda x: sorted(x))
@@ -86,35 +103,60 @@ class LocalDB_Base(ABC):
         A pandas table of behavioral data
         '''
 
+        if reload:
+            self.clear_db_cache()
+
         if utils.is_scalar(sess_ids):
             sess_ids = [sess_ids]
 
         sess_ids = sorted(sess_ids)
-        beh_data = pd.DataFrame()
+        beh_data = []
 
-        for sess_id in sess_ids:
-            # see if data already exists
-            data_path = self._get_sess_beh_path(sess_id)
+        # see if we need to pull any sessions from the database
+        if reload:
+            missing_ids = set(sess_ids)
+        else:
+            missing_ids = {sess_id for sess_id in sess_ids if not path.exists(self._get_sess_beh_path(sess_id))}
+
+        # persist the local index once for all new sessions, even if loading fails partway through,
+        # so it always matches the session files that were written
+        try:
+            # retrieve all missing sessions at once, split up by session
+            if len(missing_ids) > 0:
+                new_sess_data = db_access.get_session_data_by_id(sorted(missing_ids))
+            else:
+                new_sess_data = {}
 
-            if path.exists(data_path) and not reload:
-                sess_data = pd.read_pickle(data_path)
-            else:  # reload data
-                sess_data = db_access.get_session_data(sess_id)
-                if len(sess_data) == 0:
-                    continue
+            # read all existing local sessions in parallel
+            local_ids = [sess_id for sess_id in sess_ids if not sess_id in missing_ids]
+            local_sess_data = dict(zip(local_ids, self._read_local_files([self._get_sess_beh_path(sess_id) for sess_id in local_ids])))
 
-                sess_data = self._format_sess_data(sess_data)
+            for sess_id in sess_ids:
+                data_path = self._get_sess_beh_path(sess_id)
 
-                if self._save_locally:
-                    utils.check_make_dir(data_path)
-                    sess_data.to_pickle(data_path)
+                if sess_id in local_sess_data:
+                    sess_data = local_sess_data[sess_id]
+                else:  # format newly loaded data
+                    if not sess_id in new_sess_data:
+                        continue
 
-                self.__update_local_sessions(sess_data)
+                    sess_data = self._format_sess_data(new_sess_data[sess_id])
 
-            beh_data = pd.concat([beh_data, sess_data], ignore_index=True)
+                    if self._save_locally:
+                        self._write_local_file(sess_data, data_path)
 
+                    self.__update_local_sessions(sess_data)
+
+                beh_data.append(sess_data)
+        finally:
+            self.__save_local_data()
+
+        # combine all sessions at once, resetting the index while sorting to avoid making another copy
         if len(beh_data) > 0:
-            beh_data = beh_data.sort_values(['sessid', 'trial']).reset_index(drop=True)
+            self.__unify_categories(beh_data)
+            beh_data = pd.concat(beh_data, ignore_index=True).sort_values(['sessid', 'trial'], ignore_index=True)
+        else:
+            beh_data = pd.DataFrame()
 
         return beh_data
 
@@ -132,6 +174,9 @@ class LocalDB_Base(ABC):
         A pandas table of behavioral data
         '''
 
+        if reload:
+            self.clear_db_cache()
+
         sess_ids = db_access.get_subj_unit_sess_ids(subj_ids)
         return self.get_behavior_data(utils.flatten(sess_ids), reload)
 
@@ -149,6 +194,9 @@ class LocalDB_Base(ABC):
         A pandas table of behavioral data
         '''
 
+        if reload:
+            self.clear_db_cache()
+
         sess_ids = db_access.get_unit_sess_ids(unit_ids)
         return self.get_behavior_data(sess_ids.keys(), reload)
 
@@ -165,6 +213,11 @@ class LocalDB_Base(ABC):
         return self.get_behavior_data(self.local_sessions['sessid'])
 
 
+    def clear_db_cache(self):
+        ''' Clear the cached database id lookups, e.g. after new data has been added to the database. This is done on every reload '''
+        db_access.clear_id_cache()
+
+
     def get_protocol_unit_subject_ids(self):
         ''' Get all subject ids from the database that have unit data for the particular protocol '''
         return db_access.get_unit_protocol_subj_ids(self.protocol_name)
@@ -184,53 +237,70 @@ class LocalDB_Base(ABC):
         A pandas table of unit data
         '''
 
+        if reload:
+            self.clear_db_cache()
+
         unit_ids = sorted(unit_ids)
-        unit_data = pd.DataFrame()
+        unit_data = []
+
+        unit_sess_ids = db_access.get_unit_sess_ids(unit_ids)
+        # only pull units that the database has
+        db_unit_ids = set(utils.flatten(unit_sess_ids))
 
         # see if we need to pull any units from the database
         if reload:
-            missing_units = unit_ids
+            missing_units = [unit_id for unit_id in unit_ids if unit_id in db_unit_ids]
         else:
-            missing_units = np.setdiff1d(unit_ids, self.local_units['unitid'])
-
-        unit_sess_ids = db_access.get_unit_sess_ids(unit_ids)
-
-        # go through the units by session and either load existing or save new data
-        for sess_id, sess_unit_ids in unit_sess_ids.items():
-            # load local data
-            data_path = self._get_sess_unit_path(sess_id)
-            if path.exists(data_path):
-                sess_unit_data = pd.read_pickle(data_path)
+            local_unit_ids = set(self.local_units['unitid'].tolist())
+            missing_units = [unit_id for unit_id in unit_ids if unit_id in db_unit_ids and not unit_id in local_unit_ids]
+
+        # persist the local index once for all new units, even if loading fails partway through
+        try:
+            # retrieve all missing units at once, then split them up by session
+            if len(missing_units) > 0:
+                new_unit_data = self._format_unit_data(db_access.get_unit_data(missing_units))
+                new_sess_unit_data = {sess_id: sess_data.reset_index(drop=True) for sess_id, sess_data in new_unit_data.groupby('sessid')}
             else:
-                sess_unit_data = None
-
-            # see if we need to load any new unit data
-            missing_sess_units = np.intersect1d(sess_unit_ids, missing_units)
-            if len(missing_sess_units) > 0:
-                new_unit_data = db_access.get_unit_data(missing_sess_units)
-                new_unit_data = self._format_unit_data(new_unit_data)
-
-                if sess_unit_data is None:
-                    # this is the first time we've loaded data for this session
-                    sess_unit_data = new_unit_data
-                else:  # we have data already
-                    if reload:  # we need to remove reloaded rows
-                        sess_unit_data.drop(sess_unit_data[sess_unit_data['unitid'].isin(
-                            new_unit_data['unitid'])].index, inplace=True)
-
-                    # append new rows preserving any additional columns
-                    sess_unit_data = pd.concat([sess_unit_data, new_unit_data],
-                                               ignore_index=True).sort_values('unitid')
-
-                # save the new session unit data
-                if self._save_locally:
-                    utils.check_make_dir(data_path)
-                    sess_unit_data.to_pickle(data_path)
-
-                self.__update_local_units(new_unit_data)
+                new_sess_unit_data = {}
+
+            # read all existing local session unit data in parallel
+            local_paths = {sess_id: self._get_sess_unit_path(sess_id) for sess_id in unit_sess_ids.keys()}
+            local_paths = {sess_id: data_path for sess_id, data_path in local_paths.items() if path.exists(data_path)}
+            local_sess_unit_data = dict(zip(local_paths.keys(), self._read_local_files(list(local_paths.values()))))
+
+            # go through the units by session and either load existing or save new data
+            for sess_id, sess_unit_ids in unit_sess_ids.items():
+                data_path = self._get_sess_unit_path(sess_id)
+                sess_unit_data = local_sess_unit_data.get(sess_id)
+
+                # see if we loaded any new unit data for this session
+                if sess_id in new_sess_unit_data:
+                    new_unit_data = new_sess_unit_data[sess_id]
+
+                    if sess_unit_data is None:
+                        # this is the first time we've loaded data for this session
+                        sess_unit_data = new_unit_data
+                    else:  # we have data already
+                        if reload:  # we need to remove reloaded rows
+                            sess_unit_data.drop(sess_unit_data[sess_unit_data['unitid'].isin(
+                                new_unit_data['unitid'])].index, inplace=True)
+
+                        # append new rows preserving any additional columns
+                        sess_unit_data = pd.concat([sess_unit_data, new_unit_data],
+                                                   ignore_index=True).sort_values('unitid')
+
+                    # save the new session unit data
+                    if self._save_locally:
+                        self._write_local_file(sess_unit_data, data_path)
+
+                    self.__update_local_units(new_unit_data)
+
+                # now that we have all of our session unit data, parse it down to the units of interest
+                unit_data.append(sess_unit_data[sess_unit_data['unitid'].isin(unit_ids)])
+        finally:
+            self.__save_local_data()
 
-            # now that we have all of our session unit data, parse it down to the units of interest
-            unit_data = pd.concat([unit_data, sess_unit_data[sess_unit_data['unitid'].isin(unit_ids)]])
+        unit_data = pd.concat(unit_data) if len(unit_data) > 0 else pd.DataFrame(columns=['unitid'])
 
         return unit_data.sort_values('unitid').reset_index()
 
@@ -248,6 +318,9 @@ class LocalDB_Base(ABC):
         A pandas table of unit data
         '''
 
+        if reload:
+            self.clear_db_cache()
+
         unit_ids = db_access.get_subj_unit_ids(subj_ids)
         return self.get_unit_data(utils.flatten(unit_ids), reload)
 
@@ -265,6 +338,9 @@ class LocalDB_Base(ABC):
         A pandas table of unit data
         '''
 
+        if reload:
+            self.clear_db_cache()
+
         unit_ids = db_access.get_sess_unit_ids(sess_ids)
         return self.get_unit_data(utils.flatten(unit_ids), reload)
 
@@ -295,83 +371,98 @@ class LocalDB_Base(ABC):
         A dictionary of fiber photometry data and metadata associated with it, keyed by subject id and session id
         '''
 
+        if reload:
+            self.clear_db_cache()
+
         fp_ids = sorted(fp_ids)
-        fp_data = pd.DataFrame()
+        fp_data = []
+
+        fp_sess_ids = db_access.get_fp_sess_ids(fp_ids)
+        # only pull fp data that the database has
+        db_fp_ids = set(utils.flatten(fp_sess_ids))
 
         # see if we need to pull any units from the database
         if reload:
-            missing_ids = fp_ids
+            missing_ids = [fp_id for fp_id in fp_ids if fp_id in db_fp_ids]
         else:
-            missing_ids = np.setdiff1d(fp_ids, self.local_fp_data['fpid'])
-
-        fp_sess_ids = db_access.get_fp_sess_ids(fp_ids)
-
-        # go through the fp ids by session and either load existing or save new data
-        for sess_id, sess_fp_ids in fp_sess_ids.items():
-            # load local data
-            data_path = self._get_sess_fp_path(sess_id)
-            if path.exists(data_path):
-                sess_fp_data = pd.read_pickle(data_path)
+            local_fp_ids = set(self.local_fp_data['fpid'].tolist())
+            missing_ids = [fp_id for fp_id in fp_ids if fp_id in db_fp_ids and not fp_id in local_fp_ids]
+
+        # persist the local index once for all new fp data, even if loading fails partway through
+        try:
+            # retrieve all missing fp data at once, then split it up by session
+            if len(missing_ids) > 0:
+                new_fp_data = self._format_fp_data(db_access.get_fp_data(missing_ids))
+                new_sess_fp_data = {sess_id: sess_data.reset_index(drop=True) for sess_id, sess_data in new_fp_data.groupby('sessid')}
             else:
-                sess_fp_data = None
-
-            # see if we need to load any new fp data
-            missing_sess_fp = np.intersect1d(sess_fp_ids, missing_ids)
-            if len(missing_sess_fp) > 0:
-                new_fp_data = db_access.get_fp_data(missing_sess_fp)
-                new_fp_data = self._format_fp_data(new_fp_data)
-
-                if sess_fp_data is None:
-                    # this is the first time we've loaded data for this session
-                    sess_fp_data = new_fp_data
-                else:  # we have data already
-                    if reload:  # we need to remove reloaded rows
-                        sess_fp_data.drop(sess_fp_data[sess_fp_data['fpid'].isin(
-                            new_fp_data['fpid'])].index, inplace=True)
-
-                    # append new rows preserving any additional columns
-                    sess_fp_data = pd.concat([sess_fp_data, new_fp_data],
-                                               ignore_index=True).sort_values('fpid')
-
-                # save the new session unit data
-                if self._save_locally:
-                    utils.check_make_dir(data_path)
-                    sess_fp_data.to_pickle(data_path)
-
-                self.__update_local_fp_data(new_fp_data)
+                new_sess_fp_data = {}
+
+            # read all existing local session fp data in parallel
+            local_paths = {sess_id: self._get_sess_fp_path(sess_id) for sess_id in fp_sess_ids.keys()}
+            local_paths = {sess_id: data_path for sess_id, data_path in local_paths.items() if path.exists(data_path)}
+            local_sess_fp_data = dict(zip(local_paths.keys(), self._read_local_files(list(local_paths.values()))))
+
+            # go through the fp ids by session and either load existing or save new data
+            for sess_id, sess_fp_ids in fp_sess_ids.items():
+                data_path = self._get_sess_fp_path(sess_id)
+                sess_fp_data = local_sess_fp_data.get(sess_id)
+
+                # see if we loaded any new fp data for this session
+                if sess_id in new_sess_fp_data:
+                    new_fp_data = new_sess_fp_data[sess_id]
+
+                    if sess_fp_data is None:
+                        # this is the first time we've loaded data for this session
+                        sess_fp_data = new_fp_data
+                    else:  # we have data already
+                        if reload:  # we need to remove reloaded rows
+                            sess_fp_data.drop(sess_fp_data[sess_fp_data['fpid'].isin(
+                                new_fp_data['fpid'])].index, inplace=True)
+
+                        # append new rows preserving any additional columns
+                        sess_fp_data = pd.concat([sess_fp_data, new_fp_data],
+                                                   ignore_index=True).sort_values('fpid')
+
+                    # save the new session unit data
+                    if self._save_locally:
+                        self._write_local_file(sess_fp_data, data_path)
+
+                    self.__update_local_fp_data(new_fp_data)
+
+                # now that we have all of our session fp data, parse it down to the fpids of interest
+                fp_data.append(sess_fp_data[sess_fp_data['fpid'].isin(fp_ids)])
+        finally:
+            self.__save_local_data()
 
-            # now that we have all of our session fp data, parse it down to the fpids of interest
-            fp_data = pd.concat([fp_data, sess_fp_data[sess_fp_data['fpid'].isin(fp_ids)]])
+        fp_data = pd.concat(fp_data) if len(fp_data) > 0 else pd.DataFrame(columns=['fpid', 'subjid', 'sessid'])
 
         # reformat the fp data into a nested dictionary for ease of manipulation and viewing
-        subj_sess_ids = fp_data.groupby('subjid')['sessid'].agg(list).apply(np.unique).to_dict()
-
         # get the implant information for each subject and region
-        implant_info = {subjid: fp_data[fp_data['subjid'] == subjid][['region', 'side', 'AP', 'ML', 'DV', 'fiber_type']].drop_duplicates().set_index('region').to_dict('index')
-                        for subjid in subj_sess_ids.keys()}
+        implant_info = {subj_id: subj_fp_data[['region', 'side', 'AP', 'ML', 'DV', 'fiber_type']].drop_duplicates().set_index('region').to_dict('index')
+                        for subj_id, subj_fp_data in fp_data.groupby('subjid')}
 
         # get the fiber photometry data organized by subject and session
-        fp_data_dict = {subj_id: {sess_id: {} for sess_id in sess_ids} for subj_id, sess_ids in subj_sess_ids.items()}
-        for subj_id, sess_ids in subj_sess_ids.items():
-            for sess_id in sess_ids:
-                sess_fp_data = fp_data[(fp_data['subjid'] == subj_id) & (fp_data['sessid'] == sess_id)]
-
-                # get region-agnostic information
-                fp_data_dict[subj_id][sess_id]['trial_start_ts'] = sess_fp_data.iloc[0]['trial_start_timestamps']
-                time_data = sess_fp_data.iloc[0]['time_data']
-                fp_data_dict[subj_id][sess_id]['time'] = time_data['start'] + np.arange(time_data['length'])*time_data['dt']
-                fp_data_dict[subj_id][sess_id]['dec_info'] = time_data['dec_info']
-
-                # get signals by region
-                regions = np.unique(sess_fp_data['region'])
-                signals = {}
-                comments = {}
-                for region in regions:
-                    signals[region] = sess_fp_data[sess_fp_data['region'] == region]['fp_data'].iat[0]
-                    comments[region] = sess_fp_data[sess_fp_data['region'] == region]['comments']
-
-                fp_data_dict[subj_id][sess_id]['raw_signals'] = signals
-                fp_data_dict[subj_id][sess_id]['comments'] = comments
+        # grouping splits up the table in one pass instead of masking the whole table for every session
+        fp_data_dict = {subj_id: {} for subj_id in implant_info.keys()}
+        for (subj_id, sess_id), sess_fp_data in fp_data.groupby(['subjid', 'sessid']):
+            sess_dict = {}
+
+            # get region-agnostic information
+            sess_dict['trial_start_ts'] = sess_fp_data.iloc[0]['trial_start_timestamps']
+            time_data = sess_fp_data.iloc[0]['time_data']
+            sess_dict['time'] = time_data['start'] + np.arange(time_data['length'])*time_data['dt']
+            sess_dict['dec_info'] = time_data['dec_info']
+
+            # get signals by region
+            signals = {}
+            comments = {}
+            for region, region_fp_data in sess_fp_data.groupby('region'):
+                signals[region] = region_fp_data['fp_data'].iat[0]
+                comments[region] = region_fp_data['comments']
+
+            sess_dict['raw_signals'] = signals
+            sess_dict['comments'] = comments
+            fp_data_dict[subj_id][sess_id] = sess_dict
 
         return {'implant_info': implant_info, 'fp_data': fp_data_dict}
 
@@ -389,6 +480,9 @@ class LocalDB_Base(ABC):
         A pandas table of fp data
         '''
 
+        if reload:
+            self.clear_db_cache()
+
         # if all([sess_id in self.local_fp_data['sessid'].values for sess_id in sess_ids]):
         #     fp_ids = self.local_fp_data[self.local_fp_data['sessid'].isin(sess_ids)]['fpid']
         # else:
@@ -433,6 +527,10 @@ class LocalDB_Base(ABC):
 
     def __load_local_data(self):
         self.__local_data_path = path.join(self.data_dir, 'local_data.pkl')
+        # new local rows are buffered and only concatenated into the local tables when they are needed
+        self.__pending_data = {'units': [], 'fp_data': [], 'sessions': []}
+        # the local index is only written out when it has changed since it was last saved
+        self.__local_data_changed = False
 
         reload = False
         if path.exists(self.__local_data_path):
@@ -440,6 +538,9 @@ class LocalDB_Base(ABC):
                 self.__local_data = pickle.load(f)
 
             reload = Counter(self.__local_data.keys()) != Counter(['units', 'fp_data', 'sessions'])
+
+            if not reload:
+                self.__local_data = {key: self.__compact_local_table(data) for key, data in self.__local_data.items()}
         else:
             reload = True
 
@@ -447,56 +548,112 @@ class LocalDB_Base(ABC):
             self.__local_data = {'units': pd.DataFrame(columns=['unitid', 'subjid', 'sessid']),
                                  'fp_data': pd.DataFrame(columns=['fpid', 'subjid', 'sessid']),
                                  'sessions': pd.DataFrame(columns=['sessid', 'subjid', 'sessiondate'])}
+            self.__local_data_changed = True
 
             # check if any data is already persisted and recreate file
-            path_search = self._get_sess_unit_path('*')
-            files = glob.glob(path_search)
-            for file in files:
-                self.__update_local_units(pd.read_pickle(file), False)
+            # only the id columns are kept from each file as they are read in parallel
+            files = glob.glob(self._get_sess_unit_path('*'))
+            for unit_data in self._read_local_files(files, ['unitid', 'subjid', 'sessid']):
+                self.__update_local_units(unit_data)
 
-            path_search = self._get_sess_fp_path('*')
-            files = glob.glob(path_search)
-            for file in files:
-                self.__update_local_sessions(pd.read_pickle(file), False)
+            files = glob.glob(self._get_sess_fp_path('*'))
+            for fp_data in self._read_local_files(files, ['fpid', 'subjid', 'sessid']):
+                self.__update_local_fp_data(fp_data)
 
-            path_search = self._get_sess_beh_path('*')
-            files = glob.glob(path_search)
-            for file in files:
-                self.__update_local_sessions(pd.read_pickle(file), False)
+            files = glob.glob(self._get_sess_beh_path('*'))
+            for sess_data in self._read_local_files(files, ['sessid', 'subjid', 'sessiondate']):
+                self.__update_local_sessions(sess_data)
 
             self.__save_local_data()
 
 
     def __save_local_data(self):
-        if self._save_locally:
+        self.__flush_local_data()
+
+        if self._save_locally and self.__local_data_changed:
             utils.check_make_dir(self.__local_data_path)
 
-            with open(self.__local_data_path, 'wb') as f:
+            # write to a temporary file first so an interrupted save can't corrupt the existing index
+            tmp_path = self.__local_data_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
                 pickle.dump(self.__local_data, f)
 
-    def __update_local_units(self, unit_data, save=True):
-        self.__local_data['units'] = pd.concat([self.__local_data['units'], unit_data[['unitid', 'subjid', 'sessid']]],
-                                               ignore_index=True).sort_values('unitid')
-        if save:
-            self.__save_local_data()
-
-    def __update_local_fp_data(self, fp_data, save=True):
-        self.__local_data['fp_data'] = pd.concat([self.__local_data['fp_data'], fp_data[['fpid', 'subjid', 'sessid']]],
-                                                 ignore_index=True).sort_values('fpid')
-        if save:
-            self.__save_local_data()
-
-    def __update_local_sessions(self, sess_data, save=True):
-        self.__local_data['sessions'] = pd.concat([self.__local_data['sessions'], sess_data[['sessid', 'subjid', 'sessiondate']].drop_duplicates()],
-                                                  ignore_index=True).sort_values('sessid')
-        if save:
-            self.__save_local_data()
+            os.replace(tmp_path, self.__local_data_path)
+
+        self.__local_data_changed = False
+
+    def __flush_local_data(self):
+        # concatenate all buffered rows into the local tables at once
+        for key, sort_col in [('units', 'unitid'), ('fp_data', 'fpid'), ('sessions', 'sessid')]:
+            pending = self.__pending_data[key]
+            if len(pending) > 0:
+                # skip an empty table so it doesn't override the compact column types
+                if len(self.__local_data[key]) > 0:
+                    pending.insert(0, self.__local_data[key])
+
+                data = pd.concat(pending, ignore_index=True)
+                # new ids are usually larger than the existing ones so only sort when they aren't already in order
+                if not data[sort_col].is_monotonic_increasing:
+                    data = data.sort_values(sort_col)
+
+                self.__local_data[key] = data
+                pending.clear()
+
+    def __compact_local_table(self, data):
+        # store ids as the smallest integer type that fits them and dates as datetimes
+        # so the local tables stay small and fast to search
+        return pd.DataFrame({col: pd.to_datetime(vals) if col == 'sessiondate' else pd.to_numeric(vals, downcast='integer')
+                             for col, vals in data.items()})
+
+    def __update_local_units(self, unit_data):
+        self.__pending_data['units'].append(self.__compact_local_table(unit_data[['unitid', 'subjid', 'sessid']]))
+        self.__local_data_changed = True
+
+    def __update_local_fp_data(self, fp_data):
+        self.__pending_data['fp_data'].append(self.__compact_local_table(fp_data[['fpid', 'subjid', 'sessid']]))
+        self.__local_data_changed = True
+
+    def __update_local_sessions(self, sess_data):
+        self.__pending_data['sessions'].append(self.__compact_local_table(sess_data[['sessid', 'subjid', 'sessiondate']].drop_duplicates()))
+        self.__local_data_changed = True
+
+    def __unify_categories(self, data):
+        # categorical columns are only kept categorical when combined if they all have the same categories
+        cat_cols = set.intersection(*[set(d.select_dtypes('category').columns) for d in data])
+        for col in cat_cols:
+            categories = union_categoricals([d[col] for d in data], sort_categories=True).categories
+            for d in data:
+                d[col] = d[col].cat.set_categories(categories)
+
+    def _read_local_file(self, data_path, columns=None):
+        ''' Read a persisted session data table from the given path, optionally keeping only the given columns '''
+        with open(data_path, 'rb') as f:
+            compressed = f.read(len(_zstd_header)) == _zstd_header
+
+        data = pd.read_pickle(data_path, compression='zstd' if compressed else None)
+        if not columns is None:
+            data = data[columns]
+        return data
+
+    def _read_local_files(self, data_paths, columns=None):
+        ''' Read multiple persisted session data tables in parallel, returned in the same order as the given paths '''
+        if len(data_paths) == 0:
+            return []
+
+        # reading is mostly waiting on disk, so threads let the reads overlap
+        with ThreadPoolExecutor(max_workers=min(16, len(data_paths))) as executor:
+            return list(executor.map(lambda data_path: self._read_local_file(data_path, columns), data_paths))
+
+    def _write_local_file(self, data, data_path):
+        ''' Persist a session data table to the given path '''
+        utils.check_make_dir(data_path)
+        data.to_pickle(data_path, compression=_local_compression)
 
     def _get_sess_unit_path(self, sess_id):
-        return path.join(self.data_dir, 'units', 'unit_data_{0}.pkl'.format(str(sess_id)))
+        return path.join(self.__unit_dir, f'unit_data_{sess_id}.pkl')
 
     def _get_sess_fp_path(self, sess_id):
-        return path.join(self.data_dir, 'fp', 'fp_data_{0}.pkl'.format(str(sess_id)))
+        return path.join(self.__fp_dir, f'fp_data_{sess_id}.pkl')
 
     def _get_sess_beh_path(self, sess_id):
-        return path.join(self.data_dir, 'beh', 'sess_data_{0}.pkl'.format(str(sess_id)))
+        return path.join(self.__beh_dir, f'sess_data_{sess_id}.pkl')
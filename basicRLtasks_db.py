@@ -7,6 +7,7 @@ local database for basic RL tasks protocol
 
 import base_db
 import numpy as np
+import pandas as pd
 from pyutils import utils
 
 class LocalDB_BasicRLTasks(base_db.LocalDB_Base):
@@ -69,107 +70,153 @@ class LocalDB_BasicRLTasks(base_db.LocalDB_Base):
             case 'twoArmBandit':
                 # add in missing center port on time
                 if 'cport_on_time' not in sess_data:
-                    sess_data['cport_on_time'] = sess_data['parsed_events'].apply(lambda x: x['States']['WaitForCenterPoke'][0])
+                    sess_data['cport_on_time'] = [peh['States']['WaitForCenterPoke'][0] for peh in sess_data['parsed_events'].to_numpy()]
                 if 'cpoke_out_time' not in sess_data:
                     sess_data['cpoke_out_time'] = np.nan
 
                 # add columns for ease of analysis
                 # make sure empty cpoke in/out columns are nans
-                sess_data['cpoke_in_time'] = sess_data['cpoke_in_time'].apply(lambda x: x if utils.is_scalar(x) else np.nan)
-                sess_data['cpoke_out_time'] = sess_data['cpoke_out_time'].apply(lambda x: x if utils.is_scalar(x) else np.nan)
-                sess_data['cpoke_in_latency'] = sess_data['cpoke_in_time'] - sess_data['cport_on_time']
-                sess_data['next_cpoke_in_latency'] = np.append(sess_data['cpoke_in_latency'][1:].to_numpy(), np.nan)
-                sess_data['cpoke_out_latency'] = sess_data['cpoke_out_time'] - sess_data['response_cue_time']
+                sess_data['cpoke_in_time'] = pd.to_numeric(sess_data['cpoke_in_time'], errors='coerce')
+                sess_data['cpoke_out_time'] = pd.to_numeric(sess_data['cpoke_out_time'], errors='coerce')
+                sess_data['cpoke_in_latency'] = sess_data['cpoke_in_time'].to_numpy() - sess_data['cport_on_time'].to_numpy()
+                sess_data['next_cpoke_in_latency'] = sess_data['cpoke_in_latency'].shift(-1)
+                sess_data['cpoke_out_latency'] = sess_data['cpoke_out_time'].to_numpy() - sess_data['response_cue_time'].to_numpy()
 
                 sess_data['rewarded'] = sess_data['reward'] > 0
-                probs = sess_data[['p_reward_left', 'p_reward_right']]
-                sess_data['side_prob'] = probs.iloc[:,0].apply(lambda x: '{:.0f}'.format(x*100)) + '/' + probs.iloc[:,1].apply(lambda x: '{:.0f}'.format(x*100))
-                sess_data['block_prob'] = np.max(probs, axis=1).apply(lambda x: '{:.0f}'.format(x*100)) + '/' + np.min(probs, axis=1).apply(lambda x: '{:.0f}'.format(x*100))
-                sess_data['high_side'] = (probs.iloc[:,0] > probs.iloc[:,1]).apply(lambda x: 'left' if x else 'right')
+
+                # pull out the reward probabilities and choices once so all labels are built with vectorized operations
+                p_left = sess_data['p_reward_left'].to_numpy(dtype=float)
+                p_right = sess_data['p_reward_right'].to_numpy(dtype=float)
+                chose_left = sess_data['chose_left'].to_numpy()
+                chose_right = sess_data['chose_right'].to_numpy()
+
+                block_prob = _join_strs(_format_vals(np.maximum(p_left, p_right)*100), '/', _format_vals(np.minimum(p_left, p_right)*100))
+                sess_data['side_prob'] = _join_strs(_format_vals(p_left*100), '/', _format_vals(p_right*100))
+                sess_data['block_prob'] = block_prob
+                sess_data['high_side'] = np.where(p_left > p_right, 'left', 'right')
                 sess_data['chose_high'] = sess_data['choice'] == sess_data['high_side']
-                sess_data['choice_prob'] = sess_data.apply(
-                    lambda x: x['p_reward_left'] if x['chose_left'] else x['p_reward_right'] if x['chose_right'] else np.nan, axis=1)
 
-                sess_data['choice_block_prob'] = sess_data['choice_prob'].apply(lambda x: '{:.0f}'.format(x*100)) + ' (' + sess_data['block_prob'] + ')'
+                choice_prob = np.where(chose_left, p_left, np.where(chose_right, p_right, np.nan))
+                sess_data['choice_prob'] = choice_prob
+                sess_data['choice_block_prob'] = _join_strs(_format_vals(choice_prob*100), ' (', block_prob, ')')
 
                 # get previous reward probability of current choice, excluding no responses
                 # this only works if we format one session at a time
-                sess_data['choice_prev_prob'] = np.nan
-                resp_sel = sess_data['hit'] == True
-                sess_data_resp = sess_data[resp_sel]
-                prev_p_right = sess_data_resp['p_reward_right'][:-1].to_numpy()
-                prev_p_left = sess_data_resp['p_reward_left'][:-1].to_numpy()
-                chose_left_resp = sess_data_resp['chose_left'][1:]
-                chose_left_sel = np.insert(sess_data['chose_left'][1:], 0, False)
-                chose_right_sel = np.insert(sess_data['chose_right'][1:], 0, False)
-                sess_data.loc[chose_left_sel,'choice_prev_prob'] = prev_p_left[chose_left_resp]
-                sess_data.loc[chose_right_sel,'choice_prev_prob'] = prev_p_right[~chose_left_resp]
+                # index each response to the previous response so the probabilities can be gathered at once
+                resp_idx = np.flatnonzero(sess_data['hit'].to_numpy() == True)
+                prev_resp_idx = np.full(len(sess_data), -1)
+                prev_resp_idx[resp_idx[1:]] = resp_idx[:-1]
+                has_prev = prev_resp_idx >= 0
+                sess_data['choice_prev_prob'] = np.where(has_prev & chose_left, p_left[prev_resp_idx],
+                                                         np.where(has_prev & chose_right, p_right[prev_resp_idx], np.nan))
             case 'temporalChoice':
                 # make sure empty cpoke in columns are nans
-                sess_data['cpoke_in_time'] = sess_data['cpoke_in_time'].apply(lambda x: x if utils.is_scalar(x) else np.nan)
-                sess_data['cpoke_out_time'] = sess_data['cpoke_out_time'].apply(lambda x: x if utils.is_scalar(x) else np.nan)
-                sess_data['cpoke_in_latency'] = sess_data['cpoke_in_time'] - sess_data['cport_on_time']
-                sess_data['next_cpoke_in_latency'] = np.append(sess_data['cpoke_in_latency'][1:].to_numpy(), np.nan)
-                sess_data['cpoke_out_latency'] = sess_data['cpoke_out_time'] - sess_data['response_cue_time']
+                sess_data['cpoke_in_time'] = pd.to_numeric(sess_data['cpoke_in_time'], errors='coerce')
+                sess_data['cpoke_out_time'] = pd.to_numeric(sess_data['cpoke_out_time'], errors='coerce')
+                sess_data['cpoke_in_latency'] = sess_data['cpoke_in_time'].to_numpy() - sess_data['cport_on_time'].to_numpy()
+                sess_data['next_cpoke_in_latency'] = sess_data['cpoke_in_latency'].shift(-1)
+                sess_data['cpoke_out_latency'] = sess_data['cpoke_out_time'].to_numpy() - sess_data['response_cue_time'].to_numpy()
 
                 # fixes for older sessions with bugs
-                sess_data['fast_port'] = sess_data['fast_port'].apply(lambda x: x[0] if utils.is_list(x) else x)
+                sess_data['fast_port'] = [port[0] if utils.is_list(port) else port for port in sess_data['fast_port'].to_numpy()]
                 if 'instruct_trial' not in sess_data:
-                    sess_data['instruct_trial'] = sess_data['response_port'].apply(lambda x: len(x) == 1)
+                    sess_data['instruct_trial'] = sess_data['response_port'].str.len() == 1
+
+                # pull out the side information once so all columns are built with vectorized operations
+                rate_left = sess_data['reward_rate_left'].to_numpy(dtype=float)
+                rate_right = sess_data['reward_rate_right'].to_numpy(dtype=float)
+                delay_left = sess_data['reward_delay_left'].to_numpy(dtype=float)
+                delay_right = sess_data['reward_delay_right'].to_numpy(dtype=float)
+                length_left = sess_data['trial_length_left'].to_numpy(dtype=float)
+                length_right = sess_data['trial_length_right'].to_numpy(dtype=float)
+                chose_left = sess_data['chose_left'].to_numpy()
+                chose_right = sess_data['chose_right'].to_numpy()
+                choice = sess_data['choice'].to_numpy()
+                fast_left = sess_data['fast_port'].to_numpy() == 'left'
 
                 # collapse reward rate and delay information across response sides
-                sess_data['fast_reward_rate'] = sess_data.apply(
-                    lambda x: x['reward_rate_left'] if x['fast_port'] == 'left' else x['reward_rate_right'], axis=1)
-                sess_data['slow_reward_rate'] = sess_data.apply(
-                    lambda x: x['reward_rate_right'] if x['fast_port'] == 'left' else x['reward_rate_left'], axis=1)
-                sess_data['slow_delay'] = np.max(sess_data[['reward_delay_left', 'reward_delay_right']], axis=1)
+                # the stored columns use the original values so they keep their type, the float copies are only used for the labels
+                sess_data['fast_reward_rate'] = np.where(fast_left, sess_data['reward_rate_left'].to_numpy(), sess_data['reward_rate_right'].to_numpy())
+                sess_data['slow_reward_rate'] = np.where(fast_left, sess_data['reward_rate_right'].to_numpy(), sess_data['reward_rate_left'].to_numpy())
+                # fmax ignores missing delays the same way the table max does
+                sess_data['slow_delay'] = np.fmax(sess_data['reward_delay_left'].to_numpy(), sess_data['reward_delay_right'].to_numpy())
+                fast_rate = np.where(fast_left, rate_left, rate_right)
+                slow_rate = np.where(fast_left, rate_right, rate_left)
+                slow_delay_label = _format_vals(np.fmax(delay_left, delay_right))
 
                 # Get block rates and rewards as fast/slow
-                sess_data['block_rates'] = sess_data.apply(lambda x: '{:.0f}/{:.0f}'.format(x['fast_reward_rate'], x['slow_reward_rate']), axis=1)
-                sess_data['block_rates_delay'] = sess_data.apply(lambda x: '{}-{:.0f}'.format(x['block_rates'], x['slow_delay']), axis=1)
-                sess_data['side_rates'] = sess_data.apply(lambda x: '{:.0f}/{:.0f}'.format(x['reward_rate_left'], x['reward_rate_right']), axis=1)
-
-                poss_rewards = sess_data[['fast_reward_rate', 'slow_reward_rate']] * np.sort(sess_data[['trial_length_left', 'trial_length_right']].to_numpy(), axis=1)
-                sess_data['block_rewards'] = poss_rewards.apply(lambda x: '{:.0f}/{:.0f}'.format(x['fast_reward_rate'], x['slow_reward_rate']), axis=1)
-                sess_data['block_rewards_delay'] = sess_data.apply(lambda x: '{}-{:.0f}'.format(x['block_rewards'], x['slow_delay']), axis=1)
-                sess_data['side_rewards'] = sess_data.apply(lambda x: '{:.0f}/{:.0f}'.format(
-                    x['reward_rate_left']*x['trial_length_left'], x['reward_rate_right']*x['trial_length_right']), axis=1)
-
-                sess_data['port_speed_choice'] = sess_data.apply(lambda x: 'fast' if x['choice'] == x['fast_port'] else 'slow' if x['choice'] != 'none' else 'none', axis=1)
-                sess_data['chose_fast_port'] = sess_data['port_speed_choice'] == 'fast'
-                sess_data['chose_slow_port'] = sess_data['port_speed_choice'] == 'slow'
-                sess_data['choice_delay'] = sess_data.apply(
-                    lambda x: x['reward_delay_left'] if x['chose_left'] else x['reward_delay_right'] if x['chose_right'] else np.nan, axis=1)
-                sess_data['choice_rate'] = sess_data.apply(
-                    lambda x: x['reward_rate_left'] if x['chose_left'] else x['reward_rate_right'] if x['chose_right'] else np.nan, axis=1)
+                block_rates = _join_strs(_format_vals(fast_rate), '/', _format_vals(slow_rate))
+                sess_data['block_rates'] = block_rates
+                sess_data['block_rates_delay'] = _join_strs(block_rates, '-', slow_delay_label)
+                sess_data['side_rates'] = _join_strs(_format_vals(rate_left), '/', _format_vals(rate_right))
+
+                poss_rewards = np.stack([fast_rate, slow_rate], axis=1) * np.sort(np.stack([length_left, length_right], axis=1), axis=1)
+                block_rewards = _join_strs(_format_vals(poss_rewards[:,0]), '/', _format_vals(poss_rewards[:,1]))
+                sess_data['block_rewards'] = block_rewards
+                sess_data['block_rewards_delay'] = _join_strs(block_rewards, '-', slow_delay_label)
+                sess_data['side_rewards'] = _join_strs(_format_vals(rate_left*length_left), '/', _format_vals(rate_right*length_right))
+
+                chose_fast = choice == sess_data['fast_port'].to_numpy()
+                chose_slow = ~chose_fast & (choice != 'none')
+                sess_data['port_speed_choice'] = np.select([chose_fast, chose_slow], ['fast', 'slow'], default='none')
+                sess_data['chose_fast_port'] = chose_fast
+                sess_data['chose_slow_port'] = chose_slow
+                # use the original column values so the labels below are formatted the same as the stored values
+                sess_data['choice_delay'] = _choose_side_vals(chose_left, chose_right, sess_data['reward_delay_left'].to_numpy(), sess_data['reward_delay_right'].to_numpy())
+                sess_data['choice_rate'] = _choose_side_vals(chose_left, chose_right, sess_data['reward_rate_left'].to_numpy(), sess_data['reward_rate_right'].to_numpy())
                 sess_data['choice_rate_delay'] = sess_data['choice_rate'].apply(str) + 'μL/s - ' + sess_data['choice_delay'].apply(str) + 's'
                 sess_data['reward_delay'] = sess_data['reward'].apply(str) + 'μL - ' + sess_data['choice_delay'].apply(str) + 's'
             case 'foraging':
                 sess_data['chose_center'] = sess_data['choice'] == 'center'
-                sess_data['reward_port'] = sess_data['response_port'].apply(lambda x: [p for p in x if p != 'center'][0])
-                sess_data['reward_depletion_rate'] = sess_data.apply(lambda x: '{:.0f} μL, τ={:.1f}'.format(x['initial_reward'], x['depletion_rate']), axis=1)
-                sess_data['reward_depletion_rate_switch_delay'] = sess_data.apply(lambda x: '{}, {:.0f}s'.format(x['reward_depletion_rate'], x['patch_switch_delay']), axis=1)
+                sess_data['reward_port'] = [next(p for p in ports if p != 'center') for ports in sess_data['response_port'].to_numpy()]
+                reward_depletion_rate = _join_strs(_format_vals(sess_data['initial_reward'].to_numpy(dtype=float)), ' μL, τ=',
+                                                   _format_vals(sess_data['depletion_rate'].to_numpy(dtype=float), '%.1f'))
+                sess_data['reward_depletion_rate'] = reward_depletion_rate
+                sess_data['reward_depletion_rate_switch_delay'] = _join_strs(reward_depletion_rate, ', ', _format_vals(sess_data['patch_switch_delay'].to_numpy(dtype=float)), 's')
 
                 # cumulative harvest counts per patch
-                harvest_counts = np.zeros(len(sess_data))
-                count = 0
-                for i in range(len(sess_data)):
-                    # reset the count at the start of a block
-                    if sess_data['block_trial'].iloc[i] == 1:
-                        count = 0
-                    # only increment the count if they poked into the reward port
-                    if sess_data['choice'].iloc[i] == sess_data['reward_port'].iloc[i]:
-                        count += 1
-
-                    harvest_counts[i] = count
-
-                sess_data['patch_harvest_count'] = harvest_counts
+                # only count trials where they poked into the reward port
+                harvested = (sess_data['choice'].to_numpy() == sess_data['reward_port'].to_numpy()).astype(float)
+                cum_harvests = np.cumsum(harvested)
+                # reset the count at the start of a block by subtracting the running total from before the block started
+                block_starts = sess_data['block_trial'].to_numpy() == 1
+                block_offsets = np.maximum.accumulate(np.where(block_starts, cum_harvests - harvested, 0))
+                sess_data['patch_harvest_count'] = cum_harvests - block_offsets
 
                 # previous reward volume
                 sess_data['prev_reward'] = np.nan
-                prev_resp = np.insert(sess_data['hit'][:-1], 0, False)
-                prev_rew = np.insert(sess_data['reward'][:-1].astype('float'), 0, np.nan)
+                prev_resp = sess_data['hit'].shift(1, fill_value=False).to_numpy()
+                prev_rew = sess_data['reward'].astype('float').shift(1).to_numpy()
                 sess_data.loc[prev_resp, 'prev_reward'] = prev_rew[prev_resp]
                 sess_data['prev_reward'].ffill(inplace=True)
 
+        # store the repeated condition labels as categories to save memory and speed up grouping
+        # choice and side columns are left as strings since they are compared against each other
+        label_cols = [col for col in ['side_prob', 'block_prob', 'choice_block_prob', 'port_speed_choice', 'block_rates', 'block_rates_delay',
+                                      'side_rates', 'block_rewards', 'block_rewards_delay', 'side_rewards'] if col in sess_data.columns]
+        sess_data[label_cols] = sess_data[label_cols].astype('category')
+
         return sess_data
+
+
+def _format_vals(vals, fmt='%.0f'):
+    ''' Format an array of numbers into an array of strings with the given printf-style format '''
+    return np.char.mod(fmt, vals)
+
+
+def _choose_side_vals(chose_left, chose_right, left_vals, right_vals):
+    ''' Select the value on the chosen side for each trial and NaN for trials without a choice.
+    Values keep their original type when every trial has a choice '''
+    vals = np.where(chose_left, left_vals, right_vals)
+    no_choice = ~(chose_left | chose_right)
+    if np.any(no_choice):
+        vals = np.where(no_choice, np.nan, vals)
+    return vals
+
+
+def _join_strs(*parts):
+    ''' Element-wise concatenation of string arrays and literal strings '''
+    joined = parts[0]
+    for part in parts[1:]:
+        joined = np.char.add(joined, part)
+    return joined
@@ -6,6 +6,7 @@ Data access layer for hanks lab database
 """
 
 import mysql.connector
+import mysql.connector.pooling
 import os.path as path
 import pandas as pd
 import numpy as np
@@ -14,84 +15,76 @@ import json
 import time
 import pyutils.utils as utils
 import math
+import io
+import functools
+import inspect
 from datetime import date
+from itertools import groupby
+from operator import itemgetter
+from contextlib import closing
 from dateutil import parser
 
-# %% Get Behavioral or Physiological Data
-
-def get_session_data(session_ids):
-    '''Gets all behavioral data for the given session ids'''
-
-    if utils.is_scalar(session_ids):
-        session_ids = [session_ids]
+# use the faster orjson parser when it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-    if len(session_ids) > 1:
-        print('Retrieving {0} sessions...'.format(len(session_ids)))
+# %% Caching
 
-    start = time.perf_counter()
+# id lookups are cached since the same ids are often looked up repeatedly while gathering data
+# lookups by subject or protocol aren't cached since new data keeps being added for them
+__id_caches = []
 
-    db = __get_connector()
-    cur = db.cursor(dictionary=True, buffered=True)
+def __cache_ids(func):
+    ''' Memoize an id lookup on the set of ids and any other arguments passed in, returning copies so the cached results can't be modified.
+    The ids are the first argument of the function and, like the other arguments, can be passed by position or by name '''
 
-    id_str = ','.join([str(i) for i in session_ids])
+    signature = inspect.signature(func)
 
-    sess_query = ('select sessid, subjid, sessiondate, starttime, protocol, startstage, rigid '
-                  'from beh.sessions where sessid in ({0}) order by sessid').format(id_str)
+    @functools.lru_cache(maxsize=256)
+    def cached_func(ids, *args):
+        return func(list(ids), *args)
 
-    trial_query = ('select sessid, trialtime, trialnum, data, parsed_events from beh.trials '
-                   'where sessid in ({0}) order by sessid, trialnum')
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # bind the arguments to the function's own signature so they are keyed the same however they were passed
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        ids, *other_args = bound.arguments.values()
 
-    # get all session data
-    cur.execute(sess_query)
-    sess_rows = cur.fetchall()
+        if utils.is_scalar(ids):
+            ids = [ids]
 
-    sess_data = []
+        return {k: v.copy() for k, v in cached_func(tuple(sorted(ids)), *other_args).items()}
 
-    sess_start = time.perf_counter()
-    for i, sess in enumerate(sess_rows):
+    __id_caches.append(cached_func)
+    return wrapper
 
-        # fetch all trials for this session
-        cur.execute(trial_query.format(sess['sessid']))
-        trials = cur.fetchall()
 
-        for trial in trials:
-            # read out data stored in json
-            trial['parsed_events'] = __parse_json(trial['parsed_events'])
-            # remove data into its own dictionary
-            trial_data = __parse_json(trial.pop('data'))
-            trial_data.pop('n_done_trials')  # this is redundant
+def clear_id_cache():
+    ''' Clears all cached id lookups so they are retrieved from the database again '''
+    for cache in __id_caches:
+        cache.cache_clear()
 
-            # preload keys and values so we can edit the dictionary in the for loop
-            key_val_list = list(trial_data.items())
-            for key, value in key_val_list:
-                # convert all lists of numbers to numpy arrays
-                if not utils.is_scalar(value) and not len(value) == 0 and isinstance(value[0], numbers.Number):
-                    trial_data[key] = np.array(value)
-                # flatten any dictionary entries in trial data
-                if utils.is_dict(value):
-                    trial_data.update(**value)
-                    # remove the original dictionary entry
-                    trial_data.pop(key)
+# %% Get Behavioral or Physiological Data
 
-            # merge all dictionaries into single row
-            sess_data.append({**sess, **trial, **trial_data})
+def get_session_data(session_ids):
+    '''Gets all behavioral data for the given session ids'''
 
-        if (i % 5 == 0 or i == len(sess_rows)-1) and not i == 0:
-            print('Retrieved {0}/{1} sessions in {2:.1f} s'.format(i +
-                  1, len(session_ids), time.perf_counter()-sess_start))
+    sess_info, sess_data = __get_session_rows(session_ids)
 
-    sess_data = pd.DataFrame.from_dict(sess_data)
-    sess_data.rename(columns={'trialnum': 'trial'}, inplace=True)
+    return __build_session_table(sess_data, sess_info)
 
-    cur.close()
-    db.close()
 
-    print('Retrieved {0} sessions in {1:.1f} s'.format(len(session_ids), time.perf_counter()-start))
+def get_session_data_by_id(session_ids):
+    '''Gets all behavioral data for the given session ids.
+    Returns a dictionary of behavioral data tables indexed by session id'''
 
-    if len(sess_data) > 0:
-        sess_data.sort_values(['sessid', 'trial'], inplace=True, ignore_index=True)
+    sess_info, sess_data = __get_session_rows(session_ids)
 
-    return sess_data.infer_objects()
+    # trial rows are ordered by session so each session's table only has the fields recorded in that session
+    return {sess_id: __build_session_table(list(rows), sess_info) for sess_id, rows in groupby(sess_data, key=itemgetter('sessid'))}
 
 
 def get_unit_data(unit_ids):
@@ -103,54 +96,47 @@ def get_unit_data(unit_ids):
     print('Retrieving {0} units...'.format(len(unit_ids)))
     start = time.perf_counter()
 
-    db = __get_connector()
-    cur = db.cursor(dictionary=True, buffered=True)
+    with closing(__get_connector()) as db:
+        # rows are streamed from the server so the json can be parsed as they are read instead of holding the raw results in memory
+        cur = db.cursor(dictionary=True)
 
-    query = 'select * from met.units where unitid in ({0})'
+        query = 'select * from met.units where unitid in ({0}) order by unitid'
 
-    max_rows = 500  # number of rows to retrieve at once
+        max_rows = 500  # number of rows to retrieve at once
 
-    if len(unit_ids) < max_rows:
-        cur.execute(query.format(','.join([str(i) for i in unit_ids])))
-        db_data = cur.fetchall()
-    else:
+        # load the ids in order so the rows come back sorted
+        unit_ids = sorted(unit_ids)
+        db_data = []
         n_iter = math.ceil(len(unit_ids)/max_rows)
         batch_start = time.perf_counter()
         for i in range(n_iter):
 
             # get batch of unit ids to load
-            if i < n_iter:
-                batch_ids = unit_ids[i*max_rows:(i+1)*max_rows]
-            else:
-                batch_ids = unit_ids[i*max_rows:]
-
-            # load data
-            cur.execute(query.format(','.join([str(i) for i in batch_ids])))
-            rows = cur.fetchall()
-
-            if i == 0:
-                db_data = rows
-            else:
-                db_data = db_data + rows
+            batch_ids = unit_ids[i*max_rows:(i+1)*max_rows]
 
-            print('Retrieved {0}/{1} units in {2:.1f} s'.format(i*max_rows+cur.rowcount,
-                  len(unit_ids), time.perf_counter()-batch_start))
+            # load data, reading out data stored in json
+            cur.execute(query.format(__id_placeholders(batch_ids)), __id_params(batch_ids))
+            for row in cur:
+                row['spike_timestamps'] = __parse_array(row['spike_timestamps'])
+                row['trial_start_timestamps'] = __parse_array(row['trial_start_timestamps'])
+                row['waveform'] = __parse_json(row['waveform'])
+                db_data.append(row)
 
-    # read out data stored in json
-    for i, row in enumerate(db_data):
-        db_data[i]['spike_timestamps'] = np.array(__parse_json(row['spike_timestamps']))
-        db_data[i]['trial_start_timestamps'] = np.array(__parse_json(row['trial_start_timestamps']))
-        db_data[i]['waveform'] = __parse_json(row['waveform'])
+            if n_iter > 1:
+                print('Retrieved {0}/{1} units in {2:.1f} s'.format(i*max_rows+cur.rowcount,
+                      len(unit_ids), time.perf_counter()-batch_start))
 
-    # convert to data table
-    unit_data = pd.DataFrame.from_dict(db_data)
+        # convert to data table
+        unit_data = pd.DataFrame.from_dict(db_data)
 
-    cur.close()
-    db.close()
+        cur.close()
 
     print('Retrieved {0} units in {1:.1f} s'.format(len(unit_ids), time.perf_counter()-start))
 
-    return unit_data.sort_values('unitid', ignore_index=True).infer_objects()
+    if not unit_data['unitid'].is_monotonic_increasing:
+        unit_data = unit_data.sort_values('unitid', ignore_index=True)
+
+    return unit_data.infer_objects()
 
 
 def get_fp_data(fp_ids):
@@ -162,82 +148,71 @@ def get_fp_data(fp_ids):
     print('Retrieving {0} fp recordings...'.format(len(fp_ids)))
     start = time.perf_counter()
 
-    db = __get_connector()
-    cur = db.cursor(dictionary=True, buffered=True)
+    with closing(__get_connector()) as db:
+        # rows are streamed from the server so only one recording's raw json is held in memory at a time
+        cur = db.cursor(dictionary=True)
 
-    query = '''select a.id, a.subjid, a.sessid, a.trial_start_timestamps, a.time_data, a.fp_data, a.comments,
-               b.region, b.AP, b.ML, b.DV, b.fiber_type from met.fp_data as a inner join met.fp_implants as b
-               on a.implant_id=b.id where a.id in ({0})'''
+        query = '''select a.id, a.subjid, a.sessid, a.trial_start_timestamps, a.time_data, a.fp_data, a.comments,
+                   b.region, b.AP, b.ML, b.DV, b.fiber_type from met.fp_data as a inner join met.fp_implants as b
+                   on a.implant_id=b.id where a.id in ({0}) order by a.id'''
 
-    max_rows = 1  # number of rows to retrieve at once
+        max_rows = 8  # number of rows to retrieve at once
 
-    if len(fp_ids) < max_rows:
-        cur.execute(query.format(','.join([str(i) for i in fp_ids])))
-        db_data = cur.fetchall()
-    else:
+        # load the ids in order so the rows come back sorted
+        fp_ids = sorted(fp_ids)
+        db_data = []
         n_iter = math.ceil(len(fp_ids)/max_rows)
         batch_start = time.perf_counter()
         for i in range(n_iter):
 
             # get batch of ids to load
-            if i < n_iter:
-                batch_ids = fp_ids[i*max_rows:(i+1)*max_rows]
-            else:
-                batch_ids = fp_ids[i*max_rows:]
-
-            # load data
-            cur.execute(query.format(','.join([str(i) for i in batch_ids])))
-            rows = cur.fetchall()
-
-            if i == 0:
-                db_data = rows
-            else:
-                db_data = db_data + rows
-
-            print('Retrieved {0}/{1} fp recordings in {2:.1f} s'.format(i*max_rows+cur.rowcount,
-                  len(fp_ids), time.perf_counter()-batch_start))
-
-    # read out data stored in json
-    for i, row in enumerate(db_data):
-        db_data[i]['trial_start_timestamps'] = np.array(__parse_json(row['trial_start_timestamps']))
-        db_data[i]['time_data'] = __parse_json(row['time_data'])
-        db_data[i]['fp_data'] = __parse_json(row['fp_data'])
-
-        for key, signal in db_data[i]['fp_data'].items():
-            db_data[i]['fp_data'][key] = np.array(signal)
-
-    # convert to data table
-    fp_data = pd.DataFrame.from_dict(db_data)
+            batch_ids = fp_ids[i*max_rows:(i+1)*max_rows]
+
+            # load data, reading out data stored in json
+            cur.execute(query.format(__id_placeholders(batch_ids)), __id_params(batch_ids))
+            for row in cur:
+                row['trial_start_timestamps'] = __parse_array(row['trial_start_timestamps'])
+                row['time_data'] = __parse_json(row['time_data'])
+                row['fp_data'] = __parse_array_dict(row['fp_data'])
+                db_data.append(row)
+
+            if n_iter > 1:
+                print('Retrieved {0}/{1} fp recordings in {2:.1f} s'.format(i*max_rows+cur.rowcount,
+                      len(fp_ids), time.perf_counter()-batch_start))
+
+        # convert to data table
+        fp_data = pd.DataFrame.from_dict(db_data)
     
-    # format implant information
-    fp_data.rename(columns={'id': 'fpid'}, inplace=True)
-    fp_data[['AP', 'ML', 'DV']] = fp_data[['AP', 'ML', 'DV']].astype(float)
-    fp_data['side'] = fp_data['ML'].apply(lambda x: 'left' if x > 0 else 'right')
+        # format implant information
+        fp_data.rename(columns={'id': 'fpid'}, inplace=True)
+        fp_data[['AP', 'ML', 'DV']] = fp_data[['AP', 'ML', 'DV']].astype(float)
+        fp_data['side'] = np.where(fp_data['ML'].to_numpy() > 0, 'left', 'right')
 
-    cur.close()
-    db.close()
+        cur.close()
 
     print('Retrieved {0} fp recordings in {1:.1f} s'.format(len(fp_ids), time.perf_counter()-start))
 
-    return fp_data.sort_values('fpid', ignore_index=True).infer_objects()
+    if not fp_data['fpid'].is_monotonic_increasing:
+        fp_data = fp_data.sort_values('fpid', ignore_index=True)
+
+    return fp_data.infer_objects()
 
 
 # %% Get IDs
 
 def get_unit_protocol_subj_ids(protocol):
     ''' Gets all subject ids with unit information for a particular protocol '''
-    db = __get_connector()
-    cur = db.cursor(buffered=True)
+    with closing(__get_connector()) as db:
+        cur = db.cursor(buffered=True)
 
-    cur.execute('select distinct a.subjid from beh.sessions a, met.units b where a.protocol=\'{0}\' and a.sessid=b.sessid'
-                .format(protocol))
-    ids = cur.fetchall()
+        cur.execute('select distinct a.subjid from beh.sessions a, met.units b where a.protocol=%s and a.sessid=b.sessid order by a.subjid',
+                    (protocol,))
+        ids = cur.fetchall()
 
-    cur.close()
-    db.close()
+        cur.close()
 
-    # flatten list of tuples
-    return sorted([i[0] for i in ids])
+    # flatten list of tuples, already sorted by the query
+    return [i[0] for i in ids]
 
 
 def get_subj_unit_ids(subj_ids):
@@ -246,25 +221,21 @@ def get_subj_unit_ids(subj_ids):
     if utils.is_scalar(subj_ids):
         subj_ids = [subj_ids]
 
-    db = __get_connector()
-    cur = db.cursor(buffered=True, dictionary=True)
+    with closing(__get_connector()) as db:
+        cur = db.cursor(buffered=True)
 
-    cur.execute('select subjid, unitid from met.units where subjid in ({0})'
-                .format(','.join([str(i) for i in subj_ids])))
-    ids = cur.fetchall()
+        cur.execute('select subjid, unitid from met.units where subjid in ({0}) order by subjid, unitid'
+                    .format(__id_placeholders(subj_ids)), __id_params(subj_ids))
+        ids = cur.fetchall()
 
-    cur.close()
-    db.close()
+        cur.close()
 
     # group the unit ids by subject
     # Note: this is much faster than repeatedly querying the database
-    df = pd.DataFrame.from_dict(ids)
-    # group unit ids into a sorted list by subject id
-    df = df.groupby('subjid').agg(list)['unitid'].apply(lambda x: sorted(x))
-
-    return df.to_dict()
+    return __group_ids(ids)
 
 
+@__cache_ids
 def get_sess_unit_ids(sess_ids):
     '''Gets all unit ids for the given session ids.
     Returns a dictionary of unit ids indexed by session id'''
@@ -272,23 +243,18 @@ def get_sess_unit_ids(sess_ids):
     if utils.is_scalar(sess_ids):
         sess_ids = [sess_ids]
 
-    db = __get_connector()
-    cur = db.cursor(buffered=True, dictionary=True)
+    with closing(__get_connector()) as db:
+        cur = db.cursor(buffered=True)
 
-    cur.execute('select sessid, unitid from met.units where sessid in ({0})'
-                .format(','.join([str(i) for i in sess_ids])))
-    ids = cur.fetchall()
+        cur.execute('select sessid, unitid from met.units where sessid in ({0}) order by sessid, unitid'
+                    .format(__id_placeholders(sess_ids)), __id_params(sess_ids))
+        ids = cur.fetchall()
 
-    cur.close()
-    db.close()
+        cur.close()
 
     # group the unit ids by session
     # Note: this is much faster than repeatedly querying the database
-    df = pd.DataFrame.from_dict(ids)
-    # group unit ids into a sorted list by session id
-    df = df.groupby('sessid').agg(list)['unitid'].apply(lambda x: sorted(x))
-
-    return df.to_dict()
+    return __group_ids(ids)
 
 
 def get_subj_unit_sess_ids(subj_ids):
@@ -298,25 +264,21 @@ def get_subj_unit_sess_ids(subj_ids):
     if utils.is_scalar(subj_ids):
         subj_ids = [subj_ids]
 
-    db = __get_connector()
-    cur = db.cursor(buffered=True, dictionary=True)
+    with closing(__get_connector()) as db:
+        cur = db.cursor(buffered=True)
 
-    cur.execute('select distinct sessid, subjid from met.units where subjid in ({0})'
-                .format(','.join([str(i) for i in subj_ids])))
-    ids = cur.fetchall()
+        cur.execute('select distinct subjid, sessid from met.units where subjid in ({0}) order by subjid, sessid'
+                    .format(__id_placeholders(subj_ids)), __id_params(subj_ids))
+        ids = cur.fetchall()
 
-    cur.close()
-    db.close()
+        cur.close()
 
     # group the session ids by subject
     # Note: this is much faster than repeatedly querying the database
-    df = pd.DataFrame.from_dict(ids)
-    # group session ids into a sorted list by subject id
-    df = df.groupby('subjid').agg(list)['sessid'].apply(lambda x: sorted(x))
-
-    return df.to_dict()
+    return __group_ids(ids)
 
 
+@__cache_ids
 def get_unit_sess_ids(unit_ids):
     '''Gets all session ids for the given unit ids.
     Returns a dictionary of unit ids indexed by session id'''
@@ -324,70 +286,65 @@ def get_unit_sess_ids(unit_ids):
     if utils.is_scalar(unit_ids):
         unit_ids = [unit_ids]
 
-    db = __get_connector()
-    cur = db.cursor(buffered=True, dictionary=True)
+    with closing(__get_connector()) as db:
+        cur = db.cursor(buffered=True)
 
-    cur.execute('select sessid, unitid from met.units where unitid in ({0})'
-                .format(','.join([str(i) for i in unit_ids])))
-    ids = cur.fetchall()
+        cur.execute('select sessid, unitid from met.units where unitid in ({0}) order by sessid, unitid'
+                    .format(__id_placeholders(unit_ids)), __id_params(unit_ids))
+        ids = cur.fetchall()
 
-    cur.close()
-    db.close()
+        cur.close()
 
     # group the unit ids by session
     # Note: this is much faster than repeatedly querying the database
-    df = pd.DataFrame.from_dict(ids)
-    # group unit ids into a sorted list by session id
-    df = df.groupby('sessid').agg(list)['unitid'].apply(lambda x: sorted(x))
-
-    return df.to_dict()
+    return __group_ids(ids)
 
 
 def get_fp_data_sess_ids(protocol=None, stage_num=None, subj_ids=None):
     '''Gets all session ids with fp data optionally filtering on protocol, stage number, and subject ids,
     Returns a dictionary of session ids indexed by subject id'''
 
-    db = __get_connector()
-    cur = db.cursor(buffered=True, dictionary=True)
-
-    # first get session ids with fp data
-    if subj_ids is None:
-        cur.execute('select distinct subjid, sessid from met.fp_data')
-    else:
-        if utils.is_scalar(subj_ids):
-            subj_ids = [subj_ids]
-
-        cur.execute('select distinct subjid, sessid from met.fp_data where subjid in ({})'
-                .format(','.join([str(i) for i in subj_ids])))
-
-    ids = cur.fetchall()
-
-    cur.close()
-    db.close()
+    query = 'select distinct a.subjid, a.sessid from met.fp_data as a'
+    conditions = []
+    params = []
 
+    # filter on the session protocol and stage in the same query, only keeping sessions with trials
     if not protocol is None or not stage_num is None:
-        sess_ids = [v['sessid'] for v in ids]
-        sess_details = get_sess_protocol_stage(sess_ids)
+        query += ' inner join beh.sessions as b on a.sessid=b.sessid'
+        conditions.append('exists (select 1 from beh.trials as c where a.sessid=c.sessid)')
 
         if not protocol is None:
-            sess_details = sess_details[sess_details['protocol'] == protocol]
+            conditions.append('b.protocol=%s')
+            params.append(protocol)
 
         if not stage_num is None:
-            sess_details = sess_details[sess_details['startstage'] == stage_num]
+            conditions.append('b.startstage=%s')
+            params.append(int(stage_num))
+
+    if not subj_ids is None:
+        if utils.is_scalar(subj_ids):
+            subj_ids = [subj_ids]
 
-        df = sess_details[['subjid', 'sessid']]
+        conditions.append('a.subjid in ({0})'.format(__id_placeholders(subj_ids)))
+        params.extend(__id_params(subj_ids))
 
-    else:
-        # group the fp ids by session
-        # Note: this is much faster than repeatedly querying the database
-        df = pd.DataFrame.from_dict(ids)
+    if len(conditions) > 0:
+        query += ' where ' + ' and '.join(conditions)
+
+    with closing(__get_connector()) as db:
+        cur = db.cursor(buffered=True)
+
+        cur.execute(query + ' order by a.subjid, a.sessid', params)
+        ids = cur.fetchall()
 
-    # group unit ids into a sorted list by session id
-    df = df.groupby('subjid').agg(list)['sessid'].apply(lambda x: sorted(x))
+        cur.close()
 
-    return df.to_dict()
+    # group the session ids by subject
+    # Note: this is much faster than repeatedly querying the database
+    return __group_ids(ids)
 
 
+@__cache_ids
 def get_sess_fp_ids(sess_ids):
     '''Gets all fp ids for the given session ids.
     Returns a dictionary of fp ids indexed by session id'''
@@ -395,25 +352,21 @@ def get_sess_fp_ids(sess_ids):
     if utils.is_scalar(sess_ids):
         sess_ids = [sess_ids]
 
-    db = __get_connector()
-    cur = db.cursor(buffered=True, dictionary=True)
+    with closing(__get_connector()) as db:
+        cur = db.cursor(buffered=True)
 
-    cur.execute('select id, sessid from met.fp_data where sessid in ({0}) and subjid in (select distinct subjid from beh.sessions where sessid in ({0}))'
-                .format(','.join([str(i) for i in sess_ids])))
-    ids = cur.fetchall()
+        cur.execute('select sessid, id from met.fp_data where sessid in ({0}) and subjid in (select distinct subjid from beh.sessions where sessid in ({0})) order by sessid, id'
+                    .format(__id_placeholders(sess_ids)), __id_params(sess_ids)*2)
+        ids = cur.fetchall()
 
-    cur.close()
-    db.close()
+        cur.close()
 
     # group the fp ids by session
     # Note: this is much faster than repeatedly querying the database
-    df = pd.DataFrame.from_dict(ids)
-    # group unit ids into a sorted list by session id
-    df = df.groupby('sessid').agg(list)['id'].apply(lambda x: sorted(x))
-
-    return df.to_dict()
+    return __group_ids(ids)
 
 
+@__cache_ids
 def get_fp_sess_ids(fp_ids):
     '''Gets all session ids for the given fp ids.
     Returns a dictionary of fp ids indexed by session id'''
@@ -421,64 +374,57 @@ def get_fp_sess_ids(fp_ids):
     if utils.is_scalar(fp_ids):
         fp_ids = [fp_ids]
 
-    db = __get_connector()
-    cur = db.cursor(buffered=True, dictionary=True)
+    with closing(__get_connector()) as db:
+        cur = db.cursor(buffered=True)
 
-    cur.execute('select id, sessid from met.fp_data where id in ({0})'
-                .format(','.join([str(i) for i in fp_ids])))
-    ids = cur.fetchall()
+        cur.execute('select sessid, id from met.fp_data where id in ({0}) order by sessid, id'
+                    .format(__id_placeholders(fp_ids)), __id_params(fp_ids))
+        ids = cur.fetchall()
 
-    cur.close()
-    db.close()
+        cur.close()
 
     # group the fp ids by session
     # Note: this is much faster than repeatedly querying the database
-    df = pd.DataFrame.from_dict(ids)
-    # group fp ids into a sorted list by session id
-    df = df.groupby('sessid').agg(list)['id'].apply(lambda x: sorted(x))
-
-    return df.to_dict()
+    return __group_ids(ids)
 
 
 def get_fp_implant_info(subj_ids=None):
     '''Get fiber photometry implant information, optionally limited to the given subject ids.
     Returns a dictionary of implant information keyed by subject id'''
 
-    db = __get_connector()
+    with closing(__get_connector()) as db:
+        if subj_ids is None:
+            cur = db.cursor(buffered=True)
+            cur.execute('select distinct subjid from met.fp_implants')
+            subj_ids = utils.flatten(cur.fetchall())
+            cur.close()
+        elif utils.is_scalar(subj_ids):
+            subj_ids = [subj_ids]
 
+        cur = db.cursor(buffered=True, dictionary=True)
+        cur.execute('select * from met.fp_implants where subjid in ({0})'
+                    .format(__id_placeholders(subj_ids)), __id_params(subj_ids))
+        info = cur.fetchall()
 
-    if subj_ids is None:
-        cur = db.cursor(buffered=True)
-        cur.execute('select distinct subjid from met.fp_implants')
-        subj_ids = utils.flatten(cur.fetchall())
         cur.close()
-    elif utils.is_scalar(subj_ids):
-        subj_ids = [subj_ids]
-
-    cur = db.cursor(buffered=True, dictionary=True)
-    cur.execute('select * from met.fp_implants where subjid in ({0})'
-                .format(','.join([str(i) for i in subj_ids])))
-    info = cur.fetchall()
-
-    cur.close()
-    db.close()
 
     # group the fp info by subject id
     # Note: this is much faster than repeatedly querying the database
     df = pd.DataFrame.from_dict(info)
     # format information and add a side column
     df[['AP', 'ML', 'DV']] = df[['AP', 'ML', 'DV']].astype(float)
-    df['side'] = df['ML'].apply(lambda x: 'left' if x > 0 else 'right')
-    # group fp info into a nested dictionary keyed by subject id and region
-    subj_ids = np.unique(df['subjid'])
+    df['side'] = np.where(df['ML'].to_numpy() > 0, 'left', 'right')
 
-    return {subjid: df[df['subjid'] == subjid].drop_duplicates().set_index('region').to_dict('index')
-                    for subjid in subj_ids}
+    # group fp info into a nested dictionary keyed by subject id and region
+    return {subjid: subj_df.drop_duplicates().set_index('region').to_dict('index')
+                    for subjid, subj_df in df.groupby('subjid')}
 
 
 def get_subj_sess_ids(subj_ids, stage_num=None, stage_name=None, protocol=None, date_start=None, date_end=None):
     '''Gets all session ids for the given subject ids, optionally filtering on a stage number or name, protocol,
     start date or end date. If no stage is provided, will pull only the last stage in the database.
+    The current protocol and stage are looked up on every call, but the sessions are only cached when an end date is given
+    since sessions can still be added up to today.
     Returns a dictionary of session ids indexed by subject id'''
 
     if stage_name is not None and stage_num is not None:
@@ -487,93 +433,103 @@ def get_subj_sess_ids(subj_ids, stage_num=None, stage_name=None, protocol=None,
     if utils.is_scalar(subj_ids):
         subj_ids = [subj_ids]
 
-    db = __get_connector()
-    cur = db.cursor(buffered=True, dictionary=True)
-
-    # get the current protocol for subjects, if not provided
-    if protocol is None:
-        cur.execute('select distinct protocol from met.current_settings where subjid in ({0})'
-                    .format(','.join([str(i) for i in subj_ids])))
-        protocol = cur.fetchall()
-        protocol = list(protocol[0].values())
-
-        if len(protocol) > 1:
-            raise ValueError('Subjects are currently in different protocols. Specify a protocol or change the subject ids.')
-        else:
-            protocol = protocol[0]
-
-    # get the current protocol for subjects, if not provided
-    if stage_num is None:
-        # if stage name is provided, convert to stage number for animals
-        if stage_name is not None:
-            cur.execute('''select distinct stage from met.settings where settingsname=\'{0}\' and protocol=\'{1}\'
-                           and expgroupid in (select expgroupid from beh.sessions where protocol=\'{1}\' and subjid in ({2}))'''.format(
-                           stage_name, protocol, ','.join([str(i) for i in subj_ids])))
-            stage_num = cur.fetchall()
-            stage_num = list(stage_num[0].values())
-
-        # else get the current active stage for the protocol
-        else:
-            cur.execute('select distinct stage from met.current_settings where subjid in ({0}) and protocol=\'{1}\''
-                        .format(','.join([str(i) for i in subj_ids]), protocol))
-            stage_num = cur.fetchall()
-            stage_num = list(stage_num[0].values())
-
-        # make sure there is only one stage number
-        if len(stage_num) > 1:
-            raise ValueError('Subjects are currently in different stages. Specify a stage or change the subject ids.')
-        else:
-            stage_num = stage_num[0]
+    # only connect to look up the current protocol or stage when they aren't given
+    if protocol is None or stage_num is None:
+        with closing(__get_connector()) as db:
+            cur = db.cursor(buffered=True, dictionary=True)
+
+            # get the current protocol for subjects, if not provided
+            if protocol is None:
+                cur.execute('select distinct protocol from met.current_settings where subjid in ({0})'
+                            .format(__id_placeholders(subj_ids)), __id_params(subj_ids))
+                protocol = cur.fetchall()
+                protocol = list(protocol[0].values())
+
+                if len(protocol) > 1:
+                    raise ValueError('Subjects are currently in different protocols. Specify a protocol or change the subject ids.')
+                else:
+                    protocol = protocol[0]
+
+            # get the current protocol for subjects, if not provided
+            if stage_num is None:
+                # if stage name is provided, convert to stage number for animals
+                if stage_name is not None:
+                    cur.execute('''select distinct stage from met.settings where settingsname=%s and protocol=%s
+                                   and expgroupid in (select expgroupid from beh.sessions where protocol=%s and subjid in ({0}))'''.format(
+                                   __id_placeholders(subj_ids)), [stage_name, protocol, protocol] + __id_params(subj_ids))
+                    stage_num = cur.fetchall()
+                    stage_num = list(stage_num[0].values())
+
+                # else get the current active stage for the protocol
+                else:
+                    cur.execute('select distinct stage from met.current_settings where subjid in ({0}) and protocol=%s'
+                                .format(__id_placeholders(subj_ids)), __id_params(subj_ids) + [protocol])
+                    stage_num = cur.fetchall()
+                    stage_num = list(stage_num[0].values())
+
+                # make sure there is only one stage number
+                if len(stage_num) > 1:
+                    raise ValueError('Subjects are currently in different stages. Specify a stage or change the subject ids.')
+                else:
+                    stage_num = stage_num[0]
+
+            cur.close()
 
     if date_start is None:
         date_start = date(1900,1,1).isoformat()
 
     if date_end is None:
-        date_end = date.today().isoformat()
+        return __get_stage_sess_ids(subj_ids, int(stage_num), protocol, date_start, date.today().isoformat())
+    else:
+        return __get_cached_stage_sess_ids(subj_ids, int(stage_num), protocol, date_start, date_end)
+
+
+def __get_stage_sess_ids(subj_ids, stage_num, protocol, date_start, date_end):
+    '''Private method to get the session ids with trials for the given subject ids, stage, protocol and date range.
+    Returns a dictionary of session ids indexed by subject id'''
 
-    # get session and subject ids but filter out sessions without trials
-    cur.execute('''select sessid, subjid from beh.sessions as a where
-                startstage={0} and protocol=\'{1}\' and subjid in ({2}) and sessiondate >= \'{3}\' and sessiondate <= \'{4}\'
-                and exists (select 1 from beh.trials as b where a.sessid=b.sessid)'''
-                .format(str(stage_num), protocol, ','.join([str(i) for i in subj_ids]), date_start, date_end))
-    ids = cur.fetchall()
+    with closing(__get_connector()) as db:
+        # get session and subject ids but filter out sessions without trials
+        cur = db.cursor(buffered=True)
+        cur.execute('''select subjid, sessid from beh.sessions as a where
+                    startstage=%s and protocol=%s and subjid in ({0}) and sessiondate >= %s and sessiondate <= %s
+                    and exists (select 1 from beh.trials as b where a.sessid=b.sessid) order by subjid, sessid'''
+                    .format(__id_placeholders(subj_ids)), [stage_num, protocol] + __id_params(subj_ids) + [date_start, date_end])
+        ids = cur.fetchall()
 
-    cur.close()
-    db.close()
+        cur.close()
 
     # group the session ids by subject
     # Note: this is much faster than repeatedly querying the database
-    df = pd.DataFrame.from_dict(ids)
-    # group session ids into a sorted list by subject id
-    df = df.groupby('subjid').agg(list)['sessid'].apply(lambda x: sorted(x))
+    return __group_ids(ids)
 
-    return df.to_dict()
+
+__get_cached_stage_sess_ids = __cache_ids(__get_stage_sess_ids)
 
 
 def get_subj_sess_ids_by_date(subj_ids, date_str):
     '''Gets all session ids for the given subject ids, for the given date'''
 
+    if utils.is_scalar(subj_ids):
+        subj_ids = [subj_ids]
+
     date_str = parser.parse(date_str).isoformat()
 
-    db = __get_connector()
-    cur = db.cursor(buffered=True, dictionary=True)
+    with closing(__get_connector()) as db:
+        cur = db.cursor(buffered=True)
 
-    # get session and subject ids but filter out sessions without trials
-    cur.execute('''select sessid, subjid from beh.sessions as a where subjid in ({}) and
-                sessiondate=\'{}\' and exists (select 1 from beh.trials as b where a.sessid=b.sessid)'''
-                .format(','.join([str(i) for i in subj_ids]), date_str))
-    ids = cur.fetchall()
+        # get session and subject ids but filter out sessions without trials
+        cur.execute('''select subjid, sessid from beh.sessions as a where subjid in ({}) and
+                    sessiondate=%s and exists (select 1 from beh.trials as b where a.sessid=b.sessid)
+                    order by subjid, sessid'''
+                    .format(__id_placeholders(subj_ids)), __id_params(subj_ids) + [date_str])
+        ids = cur.fetchall()
 
-    cur.close()
-    db.close()
+        cur.close()
 
     # group the session ids by subject
     # Note: this is much faster than repeatedly querying the database
-    df = pd.DataFrame.from_dict(ids)
-    # group session ids into a sorted list by subject id
-    df = df.groupby('subjid').agg(list)['sessid'].apply(lambda x: sorted(x))
-
-    return df.to_dict()
+    return __group_ids(ids)
 
 
 def get_active_subj_stage(protocol=None, subj_ids=None, stage_num=None, stage_name=None):
@@ -583,28 +539,30 @@ def get_active_subj_stage(protocol=None, subj_ids=None, stage_num=None, stage_na
     if stage_name is not None and stage_num is not None:
         raise ValueError('Can only provide one form of stage identifier')
 
-    db = __get_connector()
+    with closing(__get_connector()) as db:
 
-    # first get all active subjects
-    cur = db.cursor(buffered=True)
-    cur.execute('select subjid from met.animals where not status = \'dead\'')
-    active_rats = cur.fetchall()
-    active_rats = np.array([i[0] for i in active_rats])
+        # first get all active subjects
+        cur = db.cursor(buffered=True)
+        cur.execute('select subjid from met.animals where not status = \'dead\'')
+        active_rats = cur.fetchall()
+        active_rats = np.array([i[0] for i in active_rats])
 
-    # optionally filter subjects
-    if not subj_ids is None:
-        active_rats = active_rats[[subj in subj_ids for subj in active_rats]]
+        # optionally filter subjects
+        if not subj_ids is None:
+            if utils.is_scalar(subj_ids):
+                subj_ids = [subj_ids]
 
-    # get all the data
-    cur = db.cursor(buffered=True, dictionary=True)
-    # cur.execute('SELECT subjid, startstage, protocol FROM beh.sessions WHERE sessid IN (SELECT MAX(sessid) FROM beh.sessions GROUP BY subjid) AND subjid IN ({0}) ORDER BY subjid'
-    #             .format(','.join([str(i) for i in active_rats])))
-    cur.execute('SELECT subjid, protocol, settingsname, stage FROM met.current_settings WHERE subjid IN ({0}) ORDER BY subjid'
-                .format(','.join([str(i) for i in active_rats])))
-    data = cur.fetchall()
+            active_rats = active_rats[np.isin(active_rats, list(subj_ids))]
 
-    cur.close()
-    db.close()
+        # get all the data
+        cur = db.cursor(buffered=True, dictionary=True)
+        # cur.execute('SELECT subjid, startstage, protocol FROM beh.sessions WHERE sessid IN (SELECT MAX(sessid) FROM beh.sessions GROUP BY subjid) AND subjid IN ({0}) ORDER BY subjid'
+        #             .format(','.join([str(i) for i in active_rats])))
+        cur.execute('SELECT subjid, protocol, settingsname, stage FROM met.current_settings WHERE subjid IN ({0}) ORDER BY subjid'
+                    .format(__id_placeholders(active_rats)), __id_params(active_rats))
+        data = cur.fetchall()
+
+        cur.close()
 
     # format into a dataframe
     df = pd.DataFrame.from_dict(data).rename(columns={'startstage': 'stage'})
@@ -625,17 +583,16 @@ def get_active_subj_stage(protocol=None, subj_ids=None, stage_num=None, stage_na
 def get_sess_protocol_stage(sess_ids):
     ''' Get the protocol name and stage number for all the given session ids'''
 
-    db = __get_connector()
-    cur = db.cursor(buffered=True, dictionary=True)
+    with closing(__get_connector()) as db:
+        cur = db.cursor(buffered=True, dictionary=True)
 
-    # get session and subject ids but filter out sessions without trials
-    cur.execute('''select sessid, subjid, protocol, startstage from beh.sessions as a where sessid in ({})
-                and exists (select 1 from beh.trials as b where a.sessid=b.sessid)'''
-                .format(','.join([str(i) for i in sess_ids])))
-    data = cur.fetchall()
+        # get session and subject ids but filter out sessions without trials
+        cur.execute('''select sessid, subjid, protocol, startstage from beh.sessions as a where sessid in ({})
+                    and exists (select 1 from beh.trials as b where a.sessid=b.sessid)'''
+                    .format(__id_placeholders(sess_ids)), __id_params(sess_ids))
+        data = cur.fetchall()
 
-    cur.close()
-    db.close()
+        cur.close()
 
     df = pd.DataFrame.from_dict(data)
 
@@ -647,113 +604,243 @@ def get_sess_protocol_stage(sess_ids):
 def add_procedure(subj_id, description, implant_type, brain_regions):
     '''Add a procedure to the procedures table'''
 
-    db = __get_connector()
-    data = {'subjid': subj_id,
-            'description': description,
-            'implant_type': implant_type,
-            'brain_regions_targeted': brain_regions}
+    with closing(__get_connector()) as db:
+        data = {'subjid': subj_id,
+                'description': description,
+                'implant_type': implant_type,
+                'brain_regions_targeted': brain_regions}
 
-    __insert(db, 'met.procedures', data)
-
-    db.close()
+        __insert(db, 'met.procedures', data)
 
 
 def add_fp_implant(subj_id, region, fiber_type, AP, ML, DV, comments=None):
     '''Add a fiber photometry implant to the fp_implants table'''
 
-    db = __get_connector()
-    cur = db.cursor()
-
-    cur.execute('select id from met.procedures where subjid={0}'.format(subj_id))
-    procedure_id = cur.fetchone()
+    with closing(__get_connector()) as db:
+        cur = db.cursor()
 
-    if procedure_id is None:
-        raise Exception('No procedures have been added for the given subject. Add a procedure for the subject before adding an implant')
-    else:
-        procedure_id = procedure_id[0]
+        cur.execute('select id from met.procedures where subjid=%s', (int(subj_id),))
+        procedure_id = cur.fetchone()
 
-    data = {'subjid': subj_id,
-            'procedure_id': procedure_id,
-            'region': region,
-            'fiber_type': fiber_type,
-            'AP': AP,
-            'ML': ML,
-            'DV': DV,
-            'comments': comments}
+        if procedure_id is None:
+            raise Exception('No procedures have been added for the given subject. Add a procedure for the subject before adding an implant')
+        else:
+            procedure_id = procedure_id[0]
 
-    __insert(db, 'met.fp_implants', data, cur=cur)
+        data = {'subjid': subj_id,
+                'procedure_id': procedure_id,
+                'region': region,
+                'fiber_type': fiber_type,
+                'AP': AP,
+                'ML': ML,
+                'DV': DV,
+                'comments': comments}
 
-    db.close()
+        __insert(db, 'met.fp_implants', data, cur=cur)
 
 
-def add_fp_data(subj_id, region, trial_start_ts, time_data, fp_data, sess_id=None, sess_date=None, comments=None):
+def add_fp_data(subj_id, region, trial_start_ts, time_data, fp_data, sess_id=None, sess_date=None, comments=None, binary=False):
     '''Add fiber photometry recording session data to the fp_data table'''
 
-    db = __get_connector()
-    cur = db.cursor()
-
-    start = time.perf_counter()
+    add_region_fp_data(subj_id, {region: fp_data}, trial_start_ts, time_data, sess_id=sess_id, sess_date=sess_date,
+                       comments={region: comments}, binary=binary)
 
-    # get the appropriate implant
-    cur.execute('select id from met.fp_implants where subjid={} and region=\'{}\''.format(subj_id, region))
-    implant_id = cur.fetchone()
 
-    if implant_id is None:
-        raise Exception('No implants have been added for the given subject and region. Add an implant before adding data')
-    else:
-        implant_id = implant_id[0]
+def add_region_fp_data(subj_id, region_fp_data, trial_start_ts, time_data, sess_id=None, sess_date=None, comments=None, binary=False):
+    '''Add fiber photometry recording session data for multiple regions to the fp_data table in a single transaction.
+    region_fp_data is a dictionary of fp data keyed by region and comments is an optional dictionary keyed by region.
+    If binary is true, the signals are stored in the binary numpy zip format instead of json'''
 
-    # get the appropriate session
     if sess_id is not None and sess_date is not None:
         raise ValueError('Either specify the session id or the session date, not both')
-    elif sess_id is None:
-        # find the session based on the date
-        if sess_date is None:
-            sess_date = date.today().isoformat()
 
-        cur.execute('select sessid from beh.sessions where subjid={} and sessiondate=\'{}\''.format(subj_id, sess_date))
-        sess_id = cur.fetchall()
+    if comments is None:
+        comments = {}
+
+    with closing(__get_connector()) as db:
+        cur = db.cursor()
+
+        start = time.perf_counter()
 
+        # find the session based on the date if no session id is given
         if sess_id is None:
-            raise Exception('No sessions were found for subject {} on {}. Either correct the date or pass in the session id instead'.format(subj_id, sess_date))
-        elif len(sess_id) > 1:
-            raise Exception('{} sessions were found for subject {} on {}. Pass in the session id instead'.format(len(sess_id), subj_id, sess_date))
+            if sess_date is None:
+                sess_date = date.today().isoformat()
+
+            sess_filter, sess_params = 'subjid=%s and sessiondate=%s', [int(subj_id), sess_date]
         else:
-            sess_id = sess_id[0]
-    else:
-        # make sure the given session id exists for the given subject
-        cur.execute('select exists(select 1 from beh.sessions where subjid={} and sessid={})'.format(subj_id, sess_id))
-        exists = bool(cur.fetchone()[0])
-        if not exists:
-            raise Exception('Session {} was not found for subject {}'.format(sess_id, subj_id))
-
-    data = {'implant_id': implant_id,
-            'subjid': subj_id,
-            'sessid': sess_id,
-            'trial_start_timestamps': __to_json(trial_start_ts),
-            'time_data': __to_json(time_data),
-            'fp_data': __to_json(fp_data),
-            'comments': comments}
-
-    # make sure we aren't adding duplicate sessions to the database
-    cur.execute('select exists(select 1 from met.fp_data where implant_id={} and sessid={})'.format(implant_id, sess_id))
-    exists = bool(cur.fetchone()[0])
-    if exists:
-        print('FP data for session {} and implant {} was already added to the database. Will update instead'.format(sess_id, implant_id))
-        __update(db, 'met.fp_data', data, 'implant_id={} and sessid={}'.format(implant_id, sess_id), cur=cur)
-    else:
-        __insert(db, 'met.fp_data', data, cur=cur)
+            sess_filter, sess_params = 'subjid=%s and sessid=%s', [int(subj_id), int(sess_id)]
+
+        query = '''select i.id, s.n_sess, s.sessid, exists(select 1 from met.fp_data as f where f.implant_id=i.id and f.sessid=s.sessid)
+                   from (select (select id from met.fp_implants where subjid=%s and region=%s limit 1) as id) as i,
+                   (select count(*) as n_sess, max(sessid) as sessid from beh.sessions where {0}) as s'''.format(sess_filter)
+
+        # the timing information is shared by all regions so only needs to be converted once
+        trial_start_json = __to_json(trial_start_ts)
+        time_json = __to_json(time_data)
+
+        for region, fp_data in region_fp_data.items():
+            # get the appropriate implant and session, and whether their data was already added, in one query
+            cur.execute(query, [int(subj_id), region] + sess_params)
+            implant_id, n_sess, found_sess_id, exists = cur.fetchone()
+
+            if implant_id is None:
+                raise Exception('No implants have been added for the given subject and region. Add an implant before adding data')
+
+            if sess_id is None:
+                if n_sess == 0:
+                    raise Exception('No sessions were found for subject {} on {}. Either correct the date or pass in the session id instead'.format(subj_id, sess_date))
+                elif n_sess > 1:
+                    raise Exception('{} sessions were found for subject {} on {}. Pass in the session id instead'.format(n_sess, subj_id, sess_date))
+            elif n_sess == 0:
+                # make sure the given session id exists for the given subject
+                raise Exception('Session {} was not found for subject {}'.format(sess_id, subj_id))
+
+            data = {'implant_id': implant_id,
+                    'subjid': subj_id,
+                    'sessid': found_sess_id,
+                    'trial_start_timestamps': trial_start_json,
+                    'time_data': time_json,
+                    'fp_data': __to_npz(fp_data) if binary else __to_json(fp_data),
+                    'comments': comments.get(region)}
+
+            # make sure we aren't adding duplicate sessions to the database
+            # rows are written one statement at a time since each recording can be close to the maximum packet size,
+            # but are only committed once all regions have been added
+            if exists:
+                print('FP data for session {} and implant {} was already added to the database. Will update instead'.format(found_sess_id, implant_id))
+                __update(db, 'met.fp_data', data, 'implant_id=%(implant_id)s and sessid=%(sessid)s', cur=cur, commit=False)
+            else:
+                __insert(db, 'met.fp_data', data, cur=cur, commit=False)
 
-    print('Added FP data for subject {} in region {} to the database in {:.1f} s'.format(subj_id, region, time.perf_counter()-start))
+        db.commit()
+        cur.close()
 
-    db.close()
+        print('Added FP data for subject {} in regions {} to the database in {:.1f} s'.format(subj_id, ', '.join(region_fp_data.keys()),
+              time.perf_counter()-start))
 
 
 # %% PRIVATE METHODS
 
+def __get_session_rows(session_ids):
+    '''Private method to get the session information and all trial rows for the given session ids'''
+
+    if utils.is_scalar(session_ids):
+        session_ids = [session_ids]
+
+    if len(session_ids) > 1:
+        print('Retrieving {0} sessions...'.format(len(session_ids)))
+
+    start = time.perf_counter()
+
+    with closing(__get_connector()) as db:
+        # trials are streamed from the server so the json can be parsed as each row is read
+        cur = db.cursor(dictionary=True)
+
+        sess_query = ('select sessid, subjid, sessiondate, starttime, protocol, startstage, rigid '
+                      'from beh.sessions where sessid in ({0}) order by sessid').format(__id_placeholders(session_ids))
+
+        trial_query = ('select sessid, trialtime, trialnum, data, parsed_events from beh.trials '
+                       'where sessid in ({0}) order by sessid, trialnum')
+
+        # get all session data
+        cur.execute(sess_query, __id_params(session_ids))
+        sess_rows = cur.fetchall()
+
+        sess_data = []
+
+        # local references for the trial loop
+        is_scalar, is_dict, Number = utils.is_scalar, utils.is_dict, numbers.Number
+
+        max_sess = 20  # number of sessions to retrieve trials for at once
+
+        sess_start = time.perf_counter()
+        for i in range(0, len(sess_rows), max_sess):
+
+            # fetch all trials for this batch of sessions
+            batch_ids = [sess['sessid'] for sess in sess_rows[i:i+max_sess]]
+            cur.execute(trial_query.format(__id_placeholders(batch_ids)), __id_params(batch_ids))
+
+            for trial in cur:
+                # read out data stored in json
+                trial['parsed_events'] = __parse_json(trial['parsed_events'])
+                # remove data into its own dictionary
+                trial_data = __parse_json(trial.pop('data'))
+                trial_data.pop('n_done_trials')  # this is redundant
+
+                # add the trial data to the trial row in one pass
+                nested_data = []
+                for key, value in trial_data.items():
+                    # flatten any dictionary entries in trial data after the other entries
+                    if is_dict(value):
+                        nested_data.append(value)
+                    # convert all lists of numbers to numpy arrays
+                    elif not is_scalar(value) and not len(value) == 0 and isinstance(value[0], Number):
+                        trial[key] = np.array(value)
+                    else:
+                        trial[key] = value
+
+                for value in nested_data:
+                    trial.update(value)
+
+                # session information is added once the table is built
+                sess_data.append(trial)
+
+            if len(sess_rows) > max_sess:
+                print('Retrieved {0}/{1} sessions in {2:.1f} s'.format(i + len(batch_ids),
+                      len(session_ids), time.perf_counter()-sess_start))
+
+        cur.close()
+
+    print('Retrieved {0} sessions in {1:.1f} s'.format(len(session_ids), time.perf_counter()-start))
+
+    return pd.DataFrame.from_dict(sess_rows), sess_data
+
+
+def __build_session_table(sess_data, sess_info):
+    '''Private method to convert a list of trial rows into a table of behavioral data, adding the session information to each trial'''
+
+    sess_data = pd.DataFrame.from_dict(sess_data)
+
+    if len(sess_data) > 0:
+        # session fields go before the trial fields, with any trial field of the same name taking precedence
+        sess_info = sess_info[[col for col in sess_info.columns if col == 'sessid' or col not in sess_data.columns]]
+        sess_data = sess_info.merge(sess_data, on='sessid', how='right')
+
+    sess_data.rename(columns={'trialnum': 'trial'}, inplace=True)
+
+    # trials are queried in order, so only sort if needed
+    if len(sess_data) > 0 and not pd.MultiIndex.from_frame(sess_data[['sessid', 'trial']]).is_monotonic_increasing:
+        sess_data.sort_values(['sessid', 'trial'], inplace=True, ignore_index=True)
+
+    return sess_data.infer_objects()
+
+
+def __group_ids(rows):
+    '''Private method to group (key, id) query rows, already sorted by key and id, into lists of ids indexed by key'''
+    return {key: [row_id for _, row_id in key_rows] for key, key_rows in groupby(rows, key=itemgetter(0))}
+
+
+def __id_placeholders(ids):
+    '''Private method to get the query parameter placeholders for an "in" clause over the given ids'''
+    return ','.join(['%s']*len(ids))
+
+
+def __id_params(ids):
+    '''Private method to get the ids as query parameters, since the connector can't convert numpy integers'''
+    return [int(i) for i in ids]
+
+
+__pool = None  # shared connection pool, created on first connection
+
 
 def __get_connector():
-    '''Private method to get the database connection'''
+    '''Private method to get a database connection from the shared connection pool'''
+    global __pool
+
+    # closing a pooled connection returns it to the pool so it can be reused by the next call
+    if __pool is not None:
+        return __pool.get_connection()
 
     config_path = path.join(path.expanduser('~'), '.dbconf')
     conn_info = {}
@@ -767,7 +854,8 @@ def __get_connector():
                     conn_info[prop_val[0].strip()] = prop_val[1].strip()
 
         try:
-            con = mysql.connector.connect(
+            __pool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name='hankslab', pool_size=4,
                 host=conn_info['host'],
                 user=conn_info['user'],
                 password=conn_info['passwd'])
@@ -795,7 +883,8 @@ def __get_connector():
 
         # try connecting before saving file
         try:
-            con = mysql.connector.connect(
+            __pool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name='hankslab', pool_size=4,
                 host=conn_info['host'],
                 user=conn_info['user'],
                 password=conn_info['passwd'])
@@ -810,12 +899,12 @@ def __get_connector():
             for name, val in conn_info.items():
                 config.write('{0} = {1}\n'.format(name, val))
 
-    return con
+    return __pool.get_connection()
 
 
 def __parse_json(x):
     '''Private method to convert json to values'''
-    tmp = json.loads(x.decode('utf-8'))
+    tmp = __load_json(x)
     #
     if 'vals' in tmp and 'info' in tmp:
         return tmp['vals']
@@ -823,14 +912,94 @@ def __parse_json(x):
         return tmp
 
 
+__npy_magic = b'\x93NUMPY'  # header of arrays stored with np.save
+__npz_magic = b'PK\x03\x04'  # header of dictionaries of arrays stored with np.savez
+
+
+def __parse_array(x):
+    '''Private method to convert a stored numeric array to a numpy array.
+    Arrays saved in the binary numpy format are read directly, otherwise they are parsed from json'''
+    if x[:len(__npy_magic)] == __npy_magic:
+        return np.load(io.BytesIO(x), allow_pickle=False)
+    else:
+        return np.array(__parse_json(x))
+
+
+def __parse_array_dict(x):
+    '''Private method to convert a stored dictionary of numeric arrays to a dictionary of numpy arrays.
+    Dictionaries saved in the binary numpy zip format are read directly, otherwise they are parsed from json'''
+    if x[:len(__npz_magic)] == __npz_magic:
+        with np.load(io.BytesIO(x), allow_pickle=False) as arrays:
+            return {key: arrays[key] for key in arrays.files}
+    else:
+        return {key: np.array(vals) for key, vals in __parse_json(x).items()}
+
+
+def __to_npz(x):
+    '''Private method to convert a dictionary of numeric arrays to bytes in the binary numpy zip format'''
+    buffer = io.BytesIO()
+    np.savez(buffer, **{key: np.asarray(vals) for key, vals in x.items()})
+    return buffer.getvalue()
+
+
+def __load_json(x):
+    '''Private method to decode json bytes, using orjson when it is available'''
+    if not orjson is None:
+        try:
+            return orjson.loads(x)
+        except orjson.JSONDecodeError:
+            # orjson doesn't accept NaN or Infinity values, which the standard json library can write
+            pass
+
+    # the standard library decodes the bytes itself, so there's no need for an intermediate string
+    return json.loads(x)
+
+
 def __to_json(x):
-    '''Private method to convert values to json'''
+    '''Private method to convert values to json, using orjson when it is available'''
+    # orjson writes NaN and Infinity as null, so keep those values as the standard json library writes them
+    if not orjson is None and not __has_nonfinite(x):
+        try:
+            return orjson.dumps(x, default=__json_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            pass
+
     return json.dumps(x, cls=json_encoder).encode('utf-8')
 
 
+def __json_default(obj):
+    '''Private method to convert numpy values that orjson can't serialize natively'''
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError
+
+
+def __has_nonfinite(x):
+    '''Private method to check whether any float values in nested data are NaN or infinite'''
+    if isinstance(x, np.ndarray):
+        return x.dtype.kind == 'f' and not np.isfinite(x).all()
+    if isinstance(x, (float, np.floating)):
+        return not math.isfinite(x)
+    if isinstance(x, dict):
+        return any(__has_nonfinite(v) for v in x.values())
+    if isinstance(x, (list, tuple)):
+        return any(__has_nonfinite(v) for v in x)
+    return False
+
+
 # Extend the JSON Encoder class to serialize objects that are not base python
 class json_encoder(json.JSONEncoder):
+    # look up the common numpy types by their exact type before falling back on the slower isinstance checks
+    _converters = {np.int64: int, np.int32: int, np.float64: float, np.float32: float, np.ndarray: np.ndarray.tolist}
+
     def default(self, obj):
+        converter = self._converters.get(type(obj))
+        if converter is not None:
+            return converter(obj)
         if isinstance(obj, np.integer):
             return int(obj)
         if isinstance(obj, np.floating):
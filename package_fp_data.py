@@ -9,9 +9,8 @@ from pyutils import utils
 from sys_neuro_tools import doric_utils as dor
 from sys_neuro_tools import acq_utils as acq
 from hankslab_db import db_access
-import tkinter as tk
-from tkinter import filedialog
 import numpy as np
+from itertools import product
 
 
 def package_doric_data(subj_id, sess_id, region_dict, wavelength_dict, comments_dict=None, data_path=None,
@@ -20,6 +19,10 @@ def package_doric_data(subj_id, sess_id, region_dict, wavelength_dict, comments_
     print('Packaging data for subject {}...'.format(subj_id))
     
     if data_path is None:
+        # only load tk when a file needs to be selected
+        import tkinter as tk
+        from tkinter import filedialog
+
         if initial_dir is None:
             initial_dir = utils.get_user_home()
 
@@ -36,17 +39,16 @@ def package_doric_data(subj_id, sess_id, region_dict, wavelength_dict, comments_
     dor_signal_path = '/DataAcquisition/FPConsole/Signals/Series0001/'
     ttl_name = 'ttl'
 
-    signal_name_dict = {ttl_name: {'time': 'DigitalIO/Time', 'values': 'DigitalIO/DIO01'}}
+    # the signal paths only differ in their templates between formats
     if new_format:
-        signal_name_dict.update({'{}_{}'.format(r, w):
-                                 {'time': 'LockInAOUT0{}/Time'.format(wavelength_dict[w]),
-                                  'values': 'LockInAOUT0{}/AIN0{}'.format(wavelength_dict[w], region_dict[r])}
-                                 for r in region_dict.keys() for w in wavelength_dict.keys()})
+        time_template, values_template = 'LockInAOUT0{w}/Time', 'LockInAOUT0{w}/AIN0{r}'
     else:
-        signal_name_dict.update({'{}_{}'.format(r, w):
-                                 {'time': 'AIN0{}xAOUT0{}-LockIn/Time'.format(region_dict[r], wavelength_dict[w]),
-                                  'values': 'AIN0{}xAOUT0{}-LockIn/Values'.format(region_dict[r], wavelength_dict[w])}
-                                 for r in region_dict.keys() for w in wavelength_dict.keys()})
+        time_template, values_template = 'AIN0{r}xAOUT0{w}-LockIn/Time', 'AIN0{r}xAOUT0{w}-LockIn/Values'
+
+    signal_name_dict = {ttl_name: {'time': 'DigitalIO/Time', 'values': 'DigitalIO/DIO01'}}
+    for r, w in product(region_dict.keys(), wavelength_dict.keys()):
+        signal_name_dict['{}_{}'.format(r, w)] = {'time': time_template.format(r=region_dict[r], w=wavelength_dict[w]),
+                                                  'values': values_template.format(r=region_dict[r], w=wavelength_dict[w])}
 
 
     data = dor.get_specific_data(data_path, dor_signal_path, signal_name_dict)
@@ -75,12 +77,17 @@ def package_doric_data(subj_id, sess_id, region_dict, wavelength_dict, comments_
 
     # no need to persist the entire timestamp array, just the elements needed to recompute
     time_data = {'start': dec_time[0], 'end': dec_time[-1], 'dt': dec_info['decimated_dt'], 'length': len(dec_time), 'dec_info': dec_info}
+    # release the timestamps and the raw signals so they aren't held in memory while the data is written to the database
+    del dec_time, signal_data, data
 
     if comments_dict is None:
         comments_dict = {r: '' for r in region_dict.keys()}
 
+    region_fp_data = {}
     for region in region_dict.keys():
         # get all signals associated with each region
         region_keys = [k for k in dec_signals.keys() if region in k]
-        fp_data = {k.replace(region+'_', ''): dec_signals[k] for k in region_keys}
-        db_access.add_fp_data(subj_id, region, trial_start_ts, time_data, fp_data, sess_id=sess_id, comments=comments_dict[region])
+        region_fp_data[region] = {k.replace(region+'_', ''): dec_signals[k] for k in region_keys}
+
+    # add all regions at once so they share a single connection and commit
+    db_access.add_region_fp_data(subj_id, region_fp_data, trial_start_ts, time_data, sess_id=sess_id, comments=comments_dict)
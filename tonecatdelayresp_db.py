@@ -41,44 +41,40 @@ class LocalDB_ToneCatDelayResp(base_db.LocalDB_Base):
         if not 'cport_on_time' in sess_data.columns:
             sess_data['cport_on_time'] = 0.016
 
-        sess_data['cpoke_in_time'] = sess_data['cpoke_in_time'].apply(lambda x: x if utils.is_scalar(x) else np.nan)
-        sess_data['cpoke_out_time'] = sess_data['cpoke_out_time'].apply(lambda x: x if utils.is_scalar(x) else np.nan)
-        sess_data['cpoke_in_latency'] = sess_data['cpoke_in_time'] - sess_data['cport_on_time']
-        sess_data['next_cpoke_in_latency'] = np.append(sess_data['cpoke_in_latency'][1:].to_numpy(), np.nan)
-        sess_data['cpoke_out_latency'] = sess_data['cpoke_out_time'] - sess_data['response_cue_time']
+        sess_data['cpoke_in_time'] = pd.to_numeric(sess_data['cpoke_in_time'], errors='coerce')
+        sess_data['cpoke_out_time'] = pd.to_numeric(sess_data['cpoke_out_time'], errors='coerce')
+        sess_data['cpoke_in_latency'] = sess_data['cpoke_in_time'].to_numpy() - sess_data['cport_on_time'].to_numpy()
+        sess_data['next_cpoke_in_latency'] = sess_data['cpoke_in_latency'].shift(-1)
+        sess_data['cpoke_out_latency'] = sess_data['cpoke_out_time'].to_numpy() - sess_data['response_cue_time'].to_numpy()
 
         # determine side and time of a response poke after a bail
         bail_sel = sess_data['bail'] == True
         # TODO: Update this for the new ITI implementation where ITI is taken at the beginning of the trial
-        sess_data.loc[bail_sel, ['choice', 'response_time']] = sess_data.loc[bail_sel].apply(self.__get_bail_response_info, axis=1, result_type='expand')
+        bail_info = [self.__get_bail_response_info(peh) for peh in sess_data.loc[bail_sel, 'parsed_events'].to_numpy()]
+        if len(bail_info) > 0:
+            sess_data.loc[bail_sel, ['choice', 'response_time']] = bail_info
 
         # determine side of previous stimulus, correct choice, and made choice of the previous full trial
         # this only works when formatting one session at a time
-        sess_data['prev_choice_tone_info'] = None
-        sess_data['prev_choice_correct_port'] = None
-        sess_data['prev_choice_side'] = None
-
         resp_sel = (sess_data['bail'] == False) & (sess_data['choice'] != 'none')
+        # scatter the shifted response values into full columns by position, then carry them forward over non-response trials
+        resp_idx = np.flatnonzero(resp_sel.to_numpy())
 
-        sess_data_resp = sess_data[resp_sel]
-        prev_stim = np.insert(sess_data_resp['tone_info'][:-1].to_numpy(), 0, None)
-        prev_port = np.insert(sess_data_resp['correct_port'][:-1].to_numpy(), 0, None)
-        prev_side = np.insert(sess_data_resp['choice'][:-1].to_numpy(), 0, None)
-
-        sess_data.loc[resp_sel,'prev_choice_tone_info'] = prev_stim
-        sess_data.loc[resp_sel,'prev_choice_correct_port'] = prev_port
-        sess_data.loc[resp_sel,'prev_choice_side'] = prev_side
+        for src_col, prev_col in [('tone_info', 'prev_choice_tone_info'), ('correct_port', 'prev_choice_correct_port'), ('choice', 'prev_choice_side')]:
+            prev_vals = np.full(len(sess_data), None, dtype=object)
+            # sessions without any responses have no previous values to fill in
+            if len(resp_idx) > 0:
+                prev_vals[resp_idx] = _shift_vals(sess_data[src_col].to_numpy()[resp_idx])
+                prev_vals = pd.Series(prev_vals, index=sess_data.index).ffill()
 
-        sess_data['prev_choice_tone_info'] = sess_data['prev_choice_tone_info'].ffill()
-        sess_data['prev_choice_correct_port'] = sess_data['prev_choice_correct_port'].ffill()
-        sess_data['prev_choice_side'] = sess_data['prev_choice_side'].ffill()
+            sess_data[prev_col] = prev_vals
 
-        sess_data['incongruent'] = sess_data['tone_info'].apply(lambda x: x[0] != x[-1] if utils.is_list(x) and len(x) == 2 else False)
+        sess_data['incongruent'] = [x[0] != x[-1] if utils.is_list(x) and len(x) == 2 else False for x in sess_data['tone_info'].to_numpy()]
         
         # fix bugs/account for protocol variability
         # some response times were None
-        sess_data['response_time'] = sess_data['response_time'].apply(lambda x: x if not x is None else np.nan)
-        sess_data['RT'] = sess_data['RT'].apply(lambda x: x if not x is None else np.nan)
+        sess_data['response_time'] = pd.to_numeric(sess_data['response_time'], errors='coerce')
+        sess_data['RT'] = pd.to_numeric(sess_data['RT'], errors='coerce')
         
         if not 'reward_time' in sess_data.columns:
             if sess_data['sessid'].iloc[0] < 95035:
@@ -92,45 +88,33 @@ class LocalDB_ToneCatDelayResp(base_db.LocalDB_Base):
 
         return sess_data
 
-    def __get_bail_response_info(self, row):
-        ''' Parse bail events to determine the choice and side of a response after a bail '''
-        response_time = np.nan
-        choice = 'none'
-
-        peh = row['parsed_events']
+    def __get_bail_response_info(self, peh):
+        ''' Parse bail events to determine the choice and time of a response after a bail '''
         bail_time = peh['States']['Bail'][0]
-        if bail_time is not None:
-            if 'Port1In' in peh['Events']:
-                left_pokes = np.array(peh['Events']['Port1In'])
-            else:
-                left_pokes = np.array([])
-
-            if 'Port3In' in peh['Events']:
-                right_pokes = np.array(peh['Events']['Port3In'])
-            else:
-                right_pokes = np.array([])
-
-            post_bail_left_pokes = left_pokes[left_pokes > bail_time]
-            post_bail_right_pokes = right_pokes[right_pokes > bail_time]
+        if bail_time is None:
+            return 'none', np.nan
 
-            if len(post_bail_left_pokes) > 0 and len(post_bail_right_pokes) > 0:
-                first_left = post_bail_left_pokes[0]
-                first_right = post_bail_right_pokes[0]
+        first_left = _get_first_poke_after(peh['Events'].get('Port1In', []), bail_time)
+        first_right = _get_first_poke_after(peh['Events'].get('Port3In', []), bail_time)
 
-                if first_left < first_right:
-                    choice = 'left'
-                    response_time = first_left
-                else:
-                    choice = 'right'
-                    response_time = first_right
+        if first_left < first_right:
+            return 'left', first_left
+        elif first_right < np.inf:
+            return 'right', first_right
+        else:
+            return 'none', np.nan
 
-            elif len(post_bail_left_pokes) > 0:
-                choice = 'left'
-                response_time = post_bail_left_pokes[0]
 
-            elif len(post_bail_right_pokes) > 0:
-                choice = 'right'
-                response_time = post_bail_right_pokes[0]
+def _shift_vals(vals):
+    ''' Shift values forward by one element into a preallocated array, filling the first element with None (NaN for numeric values) '''
+    shifted = np.empty_like(vals)
+    shifted[1:] = vals[:-1]
+    shifted[:1] = np.array([None]).astype(vals.dtype)
+    return shifted
 
 
-        return {'choice': choice, 'response_time': response_time}
+def _get_first_poke_after(pokes, time):
+    ''' Get the first poke time after the given time, infinity if there are none '''
+    if utils.is_scalar(pokes):
+        pokes = [pokes]
+    return next((t for t in pokes if t > time), np.inf)